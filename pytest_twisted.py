@@ -1,30 +1,199 @@
+import collections
+import copy
+import cProfile
 import functools
+import gc
+import importlib
 import inspect
+import json
+import os
+import pstats
+import re
 import sys
+import threading
+import traceback
 import warnings
+import weakref
+from timeit import default_timer as _clock
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+try:
+    from collections.abc import Coroutine as _Coroutine
+except ImportError:  # Python 2
+    _Coroutine = object
 
 import decorator
 import greenlet
 import pytest
+import twisted
 from twisted.internet import defer, error
 from twisted.internet.threads import blockingCallFromThread
-from twisted.python import failure
+from twisted.python import failure, threadable
+from twisted.python.threadpool import ThreadPool
 
 
 class WrongReactorAlreadyInstalledError(Exception):
     pass
 
 
+class ReactorTimeoutError(Exception):
+    pass
+
+
+class DirtyReactorError(Exception):
+    pass
+
+
+class DirtyReactorWarning(UserWarning):
+    pass
+
+
+class BlockonFailuresError(Exception):
+    """Raised by ``blockon_all`` and ``blockon_each`` if any of the deferreds
+    failed, ``failures`` lists their ``(index, failure)``.
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        Exception.__init__(
+            self,
+            "{} deferred(s) failed:\n{}".format(
+                len(failures),
+                "\n".join(
+                    "    [{}] {}: {}".format(
+                        index, f.type.__name__, f.getErrorMessage()
+                    )
+                    for index, f in failures
+                ),
+            ),
+        )
+
+
 class _config:
+    reactor_name = None
     reactor_installer = None
     external_reactor = False
+    reactor_scope = "function"
+    xdist_worker_id = None
+    dirty_reactor = "off"
+    failure_frames = "all"
+    direct_call = False
+    auto_mark = False
+    concurrency = 1
+    driver = "greenlet"
+    threadpool_minthreads = 0
+    threadpool_maxthreads = 10
+    threadpool_shared = False
+    # calls to the thread pool and their waits recorded per test
+    threadpool_stats = False
+    profile_dir = None
+    # hottest callbacks and longest chains reported per test
+    trace_callbacks = None
+    # tests ranked by their I/O
+    io_stats = None
 
 
 class _instances:
     _reactor_original = None
+    _reactor_original_used = False
+    # the delayed calls the reactor above had when the test got a reactor
+    # of its own, None while the test runs on that reactor
+    _reactor_original_calls = None
+    _clean_failure_original = None
 
     gr_twisted = None
     reactor = None
+    # the test being run, until it is torn down
+    item = None
+    # following tests started ahead of their turn -> their deferred
+    concurrent = collections.OrderedDict()
+    # async fixtures started ahead of their setup -> (async generator or
+    # None, deferred, its yielded value once it reached its yield)
+    fixture_starts = {}
+    # item -> index in session.items
+    item_positions = None
+    reactor_scope_key = None
+    reactor_pool = None
+    # runs the session's reactor with --twisted-driver=thread
+    reactor_thread = None
+    # calls dispatched to the reactor, their total and longest latency
+    dispatches = [0, 0.0, 0.0]
+    # kept across reactors with twisted_threadpool_shared
+    threadpool = None
+    # calls, max queue depth, total and longest wait for a worker of the
+    # current test
+    thread_stats = None
+    # nodeid -> thread_stats of the tests whose calls had to queue
+    thread_queues = collections.OrderedDict()
+    # the current test's I/O, counted as io_fields
+    io_stats = None
+    # nodeid -> io_stats of the tests which did any I/O
+    io_tests = collections.OrderedDict()
+    # in-memory loopback network of the current test
+    loopback = None
+    # nodeid -> connections and ports the loopback network passed on
+    loopback_fallbacks = collections.OrderedDict()
+    stall_detector = None
+    # the event loop of --reactor=asyncio-uvloop, closed at unconfigure
+    uvloop = None
+    # profiler of the current test and the merged stats of all tests
+    profiler = None
+    session_profile = None
+    callback_tracer = None
+    # nodeid -> (seconds, calls, hottest callbacks, longest chains)
+    callback_traces = collections.OrderedDict()
+    stalls = collections.OrderedDict()
+    timeout = None
+    deadline = None
+    unhandled_errors = []
+    # nodeid -> (delayed calls, readers, writers, unhandled errors)
+    dirty_reactors = collections.OrderedDict()
+    # weak references to the failures whose cleanFailure() was postponed
+    # while a test function is called, None while none is
+    postponed_failures = None
+    # weak references to failures a test waited on, kept until its teardown
+    result_failures = []
+    # failures, frames and bytes of locals released by cleaning them
+    released_failures = collections.OrderedDict(
+        (
+            ("once the test function returned", [0, 0, 0]),
+            ("after their test", [0, 0, 0]),
+        )
+    )
+
+
+class _timings:
+    # nodeid -> {phase: seconds}, None unless timings were requested
+    items = None
+    current = None
+    configure = 0.0
+    # xdist worker id -> {phase: seconds} summed over the worker's tests
+    workers = collections.OrderedDict()
+
+
+reactor_scopes = ("function", "module", "session")
+drivers = ("greenlet", "thread")
+dirty_reactor_modes = ("off", "warn", "error")
+failure_frames_modes = ("all", "result", "none")
+# Twisted before 24.10 cleans the failure a callback chain stopped at,
+# later versions leave it alone
+_cleans_failures = (
+    "cleanFailure" in defer.Deferred._runCallbacks.__code__.co_names
+)
+timing_phases = ("install", "dispatch", "resume", "teardown")
+io_fields = (
+    "connections",
+    "bytes_read",
+    "bytes_written",
+    "do_read",
+    "do_write",
+    "write_calls",
+    "iterations",
+)
 
 
 def _deprecate(deprecated, recommended):
@@ -60,15 +229,34 @@ def blockon_default(d):
     ), "blockon cannot be called from the twisted greenlet"
     result = []
 
+    if _instances.gr_twisted is None and _instances.item is not None:
+        # a fixture of a test which did not need a reactor so far
+        _instances.item.add_marker("twisted")
+        _start_test_reactor(_instances.item)
+
+    if not d.called:
+        _check_reactor_original_calls()
+    if _instances.deadline is not None and not d.called:
+        d = _with_timeout(d, _instances.deadline - _clock())
+
     def cb(r):
-        result.append(r)
+        result.append(_hold_failure(r))
         if greenlet.getcurrent() is not current:
+            fired.append(_clock())
             current.switch(result)
 
+    fired = []
     d.addCallbacks(cb, cb)
     if not result:
-        _result = _instances.gr_twisted.switch()
+        if _instances.stall_detector is not None:
+            _instances.stall_detector.arm(_instances.reactor)
+        try:
+            _result = _instances.gr_twisted.switch()
+        finally:
+            if _instances.stall_detector is not None:
+                _instances.stall_detector.disarm()
         assert _result is result, "illegal switch in blockon"
+        _record_timing("resume", _clock() - fired[0])
 
     if isinstance(result[0], failure.Failure):
         result[0].raiseException()
@@ -76,39 +264,741 @@ def blockon_default(d):
     return result[0]
 
 
+def _check_reactor_original_calls():
+    # e.g. a module imported the reactor at configure time and a fixture
+    # scheduled calls on it, which never run while the test's reactor does
+    known = _instances._reactor_original_calls
+    if known is None:
+        return
+
+    scheduled = [
+        call
+        for call in _instances._reactor_original.getDelayedCalls()
+        if call not in known
+    ]
+    if scheduled:
+        raise RuntimeError(
+            "blockon would wait forever for calls scheduled on the reactor "
+            "installed at configure time, which does not run while the "
+            "test's own reactor does: {}\nimport twisted.internet.reactor "
+            "within the test or fixture, or use "
+            "--twisted-reactor-scope=session".format(
+                ", ".join(repr(_unwrapped_delayed_call(c)) for c in scheduled)
+            )
+        )
+
+
 def block_from_thread(d):
-    return blockingCallFromThread(_instances.reactor, lambda x: x, d)
+    return _call_in_reactor(_with_deadline, d)
+
+
+def _call_in_reactor(f, *args):
+    if _instances.reactor_thread is not None:
+        return _instances.reactor_thread.call(f, *args)
+
+    return blockingCallFromThread(_instances.reactor, f, *args)
+
+
+def _in_reactor(f, *args):
+    # call f where the reactor runs, which is the test greenlet's own thread
+    # unless the reactor runs in another one
+    if _config.external_reactor and not _in_reactor_thread():
+        return _call_in_reactor(f, *args)
+
+    return f(*args)
+
+
+def _in_reactor_thread():
+    # e.g. a coroutine test, which the thread driver runs on the reactor
+    if _instances.reactor_thread is not None:
+        return _instances.reactor_thread.is_current()
+
+    return threadable.isInIOThread()
+
+
+def _blockon_call(f, *args):
+    """Call ``f`` where the reactor runs and wait for the deferred it
+    returns, unlike ``blockon(f(*args))`` which calls it in this thread."""
+    if _config.external_reactor:
+        return _call_in_reactor(
+            lambda: _with_deadline(defer.maybeDeferred(f, *args))
+        )
+
+    return blockon_default(defer.maybeDeferred(f, *args))
+
+
+def blockon_all(deferreds, consume_errors=False):
+    """Wait for all of ``deferreds`` at once and return their results.
+
+    Unlike calling ``blockon`` for each of them this only switches to the
+    reactor, or hops to its thread, once.  If any of them fail, a
+    ``BlockonFailuresError`` with all of the failures is raised after all
+    of them fired.  Those failures are consumed as they are raised again,
+    ``consume_errors`` is passed on to ``DeferredList`` for the others.
+    """
+    return _all_results(
+        _blockon_call(_deferred_list, list(deferreds), consume_errors)
+    )
+
+
+def _deferred_list(deferreds, consume_errors):
+    if _keeps_result_frames():
+        # the failures end up in the BlockonFailuresError
+        for d in deferreds:
+            d.addErrback(_hold_failure)
+    waited = defer.DeferredList(deferreds, consumeErrors=consume_errors)
+    waited.addCallback(_consume_raised_failures, deferreds)
+    return waited
+
+
+def _consume_raised_failures(results, deferreds):
+    # they are raised in a BlockonFailuresError, so they are handled
+    _consume_failures(
+        [d for d, (success, _) in zip(deferreds, results) if not success]
+    )
+    return results
+
+
+def _consume_failures(deferreds):
+    for d in deferreds:
+        d.addErrback(lambda _: None)
+
+
+def _all_results(results):
+    failures = [
+        (index, result)
+        for index, (success, result) in enumerate(results)
+        if not success
+    ]
+    if failures:
+        raise BlockonFailuresError(failures)
+
+    return [result for _, result in results]
+
+
+def blockon_each(deferreds, consume_errors=False):
+    """Iterate over the results of ``deferreds`` in the order they fire.
+
+    The reactor is only switched to when none of the remaining deferreds
+    fired yet.  Coroutines can use ``async for`` instead, which waits on
+    the reactor without blocking.  Failures are collected and raised as a
+    ``BlockonFailuresError`` once all of the deferreds fired, and consumed
+    then.  ``consume_errors`` consumes the others too, e.g. when iterating
+    stopped early.
+    """
+    return _FiringOrder(deferreds, consume_errors)
+
+
+class _FiringOrder(object):
+    _pending = object()
+    _exhausted = object()
+
+    def __init__(self, deferreds, consume_errors):
+        deferreds = list(deferreds)
+        self._remaining = len(deferreds)
+        # (index, result) in the order they fired, not yet consumed
+        self._fired = collections.deque()
+        self._failures = []
+        self._deferreds = deferreds
+        self._waiting = None
+        _in_reactor(self._watch, deferreds, consume_errors)
+
+    def _watch(self, deferreds, consume_errors):
+        for index, d in enumerate(deferreds):
+            d.addBoth(self._fire, index, consume_errors)
+
+    def _fire(self, result, index, consume_errors):
+        self._fired.append((index, _hold_failure(result)))
+        waiting, self._waiting = self._waiting, None
+        if waiting is not None:
+            waiting.callback(None)
+        if consume_errors and isinstance(result, failure.Failure):
+            return None
+        return result
+
+    def _wait(self):
+        # runs in the reactor thread, where _fire() runs too
+        if self._fired:
+            return defer.succeed(None)
+        self._waiting = defer.Deferred()
+        return self._waiting
+
+    def _take(self):
+        while self._fired:
+            index, result = self._fired.popleft()
+            self._remaining -= 1
+            if isinstance(result, failure.Failure):
+                self._failures.append((index, result))
+            else:
+                return result
+
+        if self._remaining:
+            return self._pending
+        if self._failures:
+            failures, self._failures = self._failures, []
+            _in_reactor(
+                _consume_failures,
+                [self._deferreds[index] for index, _ in failures],
+            )
+            raise BlockonFailuresError(failures)
+        return self._exhausted
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        result = self._take()
+        while result is self._pending:
+            _blockon_call(self._wait)
+            result = self._take()
+
+        if result is self._exhausted:
+            raise StopIteration
+        return result
+
+    next = __next__
+
+    def __aiter__(self):
+        return self
+
+    @defer.inlineCallbacks
+    def __anext__(self):
+        result = self._take()
+        while result is self._pending:
+            yield self._wait()
+            result = self._take()
+
+        if result is self._exhausted:
+            raise StopAsyncIteration  # noqa: F821, Python 3 only
+        defer.returnValue(result)
+
+
+def _with_deadline(d):
+    if _instances.deadline is None:
+        return d
+
+    return _with_timeout(d, _instances.deadline - _clock())
+
+
+def _with_timeout(d, timeout):
+    """Cancel ``d`` unless it fires within ``timeout`` seconds, failing it
+    with a ReactorTimeoutError describing what the reactor was waiting on.
+    """
+    reactor = _instances.reactor
+    expired = []
+
+    def expire():
+        expired.append(_describe_reactor(reactor))
+        d.cancel()
 
+    # on the wall clock even when the reactor's own clock is virtual
+    call_later = getattr(reactor, "_callLaterWallClock", reactor.callLater)
+    timeout_call = call_later(max(timeout, 0), expire)
 
+    def done(result):
+        if timeout_call.active():
+            timeout_call.cancel()
+        if expired and isinstance(result, failure.Failure):
+            raise ReactorTimeoutError(
+                "timed out after {:.3f}s\n{}".format(
+                    _instances.timeout, expired[0]
+                )
+            )
+        return result
+
+    return d.addBoth(done)
+
+
+def _describe_reactor(reactor):
+    lines = []
+    for title, pending in zip(
+        ("pending delayed calls", "readers", "writers"),
+        _reactor_leftovers(reactor),
+    ):
+        lines.append("{}:".format(title))
+        lines.extend(
+            "    {!r}".format(_unwrapped_delayed_call(x)) for x in pending
+        )
+        if not pending:
+            lines.append("    none")
+    return "\n".join(lines)
+
+
+def _unwrapped_delayed_call(call):
+    # the asyncio reactor of Twisted before 20.3 schedules a closure calling
+    # the actual function, which says nothing about what is pending
+    func = getattr(call, "func", None)
+    if getattr(func, "__name__", None) != "run" or not func.__closure__:
+        return call
+    cells = dict(
+        zip(
+            func.__code__.co_freevars,
+            (cell.cell_contents for cell in func.__closure__),
+        )
+    )
+    if not {"f", "args", "kwargs"} <= set(cells):
+        return call
+
+    unwrapped = copy.copy(call)
+    unwrapped.func = cells["f"]
+    unwrapped.args = cells["args"]
+    unwrapped.kw = cells["kwargs"]
+    return unwrapped
+
+
+def _marks_twisted(decorate):
+    # lets --twisted-auto-mark recognize the decorated tests
+    @functools.wraps(decorate)
+    def mark(fun):
+        fun = decorate(fun)
+        fun._pytest_twisted = True
+        return fun
+
+    return mark
+
+
+@_marks_twisted
 @decorator.decorator
 def inlineCallbacks(fun, *args, **kw):
     return defer.inlineCallbacks(fun)(*args, **kw)
 
 
+@_marks_twisted
 @decorator.decorator
 def ensureDeferred(fun, *args, **kw):
-    return defer.ensureDeferred(fun(*args, **kw))
+    return _coroutine_deferred(fun(*args, **kw))
+
+
+_iscoroutine = getattr(inspect, "iscoroutine", lambda obj: False)
+_iscoroutinefunction = getattr(
+    inspect, "iscoroutinefunction", lambda obj: False
+)
+_isasyncgenfunction = getattr(
+    inspect, "isasyncgenfunction", lambda obj: False
+)
+
+
+def _coroutine_deferred(coro):
+    # with an asyncio reactor, run the coroutine as a task of its event
+    # loop instead of resuming it from Deferred callbacks after every await
+    loop = getattr(_instances.reactor, "_asyncioEventloop", None)
+    if loop is None:
+        return defer.ensureDeferred(coro)
+
+    awaiting = _DeferredAwaitingCoroutine(coro, loop)
+    task = loop.create_task(awaiting)
+
+    def cancel(d):
+        # e.g. the test timed out; cancelling the task only reaches the
+        # awaited Deferred from a later loop iteration, by when the reactor
+        # may have stopped, so cancel that one right away
+        awaiting.cancel_waiting()
+        task.cancel()
+
+    def finished(result):
+        # unless it was cancelled already
+        if d.called:
+            return
+        if isinstance(result, failure.Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    d = defer.Deferred(cancel)
+    defer.Deferred.fromFuture(task).addBoth(finished)
+    return d
+
+
+class _DeferredAwaitingCoroutine(_Coroutine):
+    """Wrap a coroutine so that an asyncio task can drive it even though it
+    awaits Deferreds.
+
+    A Deferred is only adapted to a future of ``loop`` when the coroutine
+    actually has to wait for it.
+    """
+
+    def __init__(self, coro, loop):
+        self._coro = coro
+        self._loop = loop
+        # the Deferred the coroutine currently waits for
+        self._waiting = None
+
+    def send(self, value):
+        return self._adapt(self._coro.send(value))
+
+    def throw(self, *args):
+        return self._adapt(self._coro.throw(*args))
+
+    def close(self):
+        self._coro.close()
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def _adapt(self, yielded):
+        if not isinstance(yielded, defer.Deferred):
+            return yielded
+
+        future = self._loop.create_future()
+
+        def wake(result):
+            # leave the result in place, Deferred.send() picks it up once
+            # the task resumes the coroutine
+            if self._waiting is yielded:
+                self._waiting = None
+            if not future.done():
+                future.set_result(None)
+            return result
+
+        def cancel(future):
+            # e.g. the coroutine was cancelled by asyncio.wait_for()
+            if future.cancelled():
+                _cancel_awaited(yielded)
+
+        self._waiting = yielded
+        yielded.addBoth(wake)
+        future.add_done_callback(cancel)
+        future._asyncio_future_blocking = True
+        return future
+
+    def cancel_waiting(self):
+        waiting, self._waiting = self._waiting, None
+        if waiting is not None:
+            _cancel_awaited(waiting)
+
+
+def _cancel_awaited(d):
+    d.cancel()
+    # the cancelled coroutine no longer picks up the failure
+    d.addErrback(lambda f: f.trap(defer.CancelledError))
+
+
+def _drive(awaitable, result):
+    # a generator awaiting ``awaitable``, which defer.ensureDeferred()
+    # accepts unlike e.g. the awaitables of async generators; its result
+    # is appended to ``result`` as a generator cannot return it on Python 2
+    iterator = awaitable.__await__()
+    step = iterator.send, None
+    while True:
+        try:
+            yielded = step[0](step[1])
+        except StopIteration as e:
+            result.append(e.value)
+            return
+
+        try:
+            step = iterator.send, (yield yielded)
+        except GeneratorExit:
+            iterator.close()
+            raise
+        except BaseException as e:
+            step = iterator.throw, e
+
+
+def _await_deferred(awaitable):
+    result = []
+    d = _coroutine_deferred(_drive(awaitable, result))
+    d.addCallback(lambda _: result[0])
+    return d
+
+
+def _is_async_fixture(func):
+    if _iscoroutinefunction(func) or _isasyncgenfunction(func):
+        return True
+    return getattr(func, "_pytest_twisted", False)
+
+
+def _start_async_fixture(func, kwargs):
+    # the fixture's code runs on the reactor from its very start
+    return _in_reactor(_start_async_fixture_now, func, kwargs)
+
+
+def _start_async_fixture_now(func, kwargs):
+    if _isasyncgenfunction(func):
+        agen = func(**kwargs)
+        # filled in by the coroutine itself once the generator reached its
+        # yield, which is before the deferred fires on the asyncio reactor
+        yielded = []
+        d = _coroutine_deferred(_drive(agen.__anext__(), yielded))
+        d.addCallback(lambda _: yielded[0])
+        return agen, d, yielded
+
+    return None, defer.maybeDeferred(_run_fixture, func, kwargs), None
+
+
+def _run_fixture(func, kwargs):
+    result = func(**kwargs)
+    if _iscoroutine(result):
+        return _coroutine_deferred(result)
+
+    return result
+
+
+def _async_fixture_wrapper(fixturedef):
+    """Return a synchronous fixture function which runs the async fixture
+    function of ``fixturedef`` on the reactor.
+    """
+    func = fixturedef.func
+
+    def start(kwargs):
+        started = _instances.fixture_starts.pop(fixturedef, None)
+        if started is None:
+            started = _start_async_fixture(func, kwargs)
+        return started
+
+    if _isasyncgenfunction(func):
+
+        def wrapper(**kwargs):
+            agen, d, _ = start(kwargs)
+            yield blockon(d)
+            try:
+                _blockon_call(_await_deferred, agen.__anext__())
+            except StopAsyncIteration:  # noqa: F821, Python 3 only
+                pass
+            else:
+                raise ValueError(
+                    "async fixture {} yielded more than once".format(
+                        fixturedef.argname
+                    )
+                )
+
+    else:
+
+        def wrapper(**kwargs):
+            _, d, _ = start(kwargs)
+            return blockon(d)
+
+    wrapper._pytest_twisted = True
+    wrapper._pytest_twisted_fixture = func
+    return wrapper
+
+
+def _original_fixture_func(fixturedef):
+    return getattr(
+        fixturedef.func, "_pytest_twisted_fixture", fixturedef.func
+    )
+
+
+def _start_async_fixtures(fixturedef, request):
+    """Start the async fixture of ``fixturedef`` together with the async
+    fixtures which pytest sets up right after it, instead of one after
+    another.
+
+    Only fixtures which depend on no other fixture are started, and only
+    once the test itself asks for the first of them, so that every fixture
+    ahead of them in its setup order is already set up.
+    """
+    item = request._pyfuncitem
+    if getattr(request, "_parent_request", None) is not getattr(
+        item, "_request", None
+    ):
+        # set up for another fixture, which is not set up itself yet
+        return
+    fixtureinfo = getattr(item, "_fixtureinfo", None)
+    if fixtureinfo is None or fixturedef.argname not in item.fixturenames:
+        return
+
+    names = item.fixturenames
+    for name in names[names.index(fixturedef.argname):]:
+        fixturedefs = fixtureinfo.name2fixturedefs.get(name)
+        if not fixturedefs:
+            return
+
+        following = fixturedefs[-1]
+        if getattr(following, "cached_result", None) is not None:
+            # a higher scoped fixture which pytest skips as well
+            continue
+        if not _may_start_async_fixture(following):
+            return
+        if following not in _instances.fixture_starts:
+            _instances.fixture_starts[following] = _start_async_fixture(
+                _original_fixture_func(following), {}
+            )
+
+
+def _may_start_async_fixture(fixturedef):
+    if fixturedef.argnames or fixturedef.params is not None:
+        return False
+    return _is_async_fixture(_original_fixture_func(fixturedef))
+
+
+def _drop_async_fixture_starts():
+    # e.g. when the setup of an earlier fixture failed
+    starts = list(_instances.fixture_starts.values())
+    _instances.fixture_starts.clear()
+    _all_results(_blockon_call(_finish_async_fixture_starts, starts))
+
+
+def _finish_async_fixture_starts(starts):
+    teardowns = []
+    for agen, d, yielded in starts:
+        if yielded:
+            # past its yield, so it has to be torn down, even if its
+            # deferred did not fire yet
+            teardowns.append(_finish_async_generator(agen))
+            continue
+        d.addErrback(lambda _: None)
+        d.cancel()
+    return defer.DeferredList(teardowns, consumeErrors=True)
+
+
+def _finish_async_generator(agen):
+    """Run the teardown of an async generator fixture, the code after its
+    yield, and close it should it yield again."""
+    d = _await_deferred(agen.__anext__())
+    d.addCallbacks(
+        lambda _: _await_deferred(agen.aclose()),
+        lambda f: f.trap(StopAsyncIteration),  # noqa: F821, Python 3 only
+    )
+    return d
 
 
 def init_twisted_greenlet():
     if _instances.reactor is None or _instances.gr_twisted:
         return
+    if _instances.reactor_thread is not None:
+        return
 
     if not _instances.reactor.running:
-        _instances.gr_twisted = greenlet.greenlet(_instances.reactor.run)
-        # give me better tracebacks:
-        failure.Failure.cleanFailure = lambda self: None
+        _instances.gr_twisted = greenlet.greenlet(
+            _unfrozen(_instances.reactor, "run")
+        )
+        _patch_clean_failure()
     else:
         _config.external_reactor = True
 
 
+def _patch_clean_failure():
+    # give me better tracebacks:
+    if _config.failure_frames != "all" or not _cleans_failures:
+        return
+    if _instances._clean_failure_original is not None:
+        return
+
+    _instances._clean_failure_original = failure.Failure.cleanFailure
+    failure.Failure.cleanFailure = lambda self: None
+
+
+def _keeps_result_frames():
+    return _config.failure_frames == "result" and _cleans_failures
+
+
+def _keeping_result_frames(f, *args):
+    """Call the test function through ``f``, keeping the frames of the
+    failure its deferred fails with.
+
+    Twisted cleans a failure once a callback chain stops at it, so the
+    failure of a deferred which already failed when the test returns it
+    would be reported without its traceback.  Failures are rather cleaned
+    once ``f`` returned, unless they are the one it returned.  Deferreds
+    failing later are waited on by the plugin already, which gets their
+    failure before Twisted cleans it.
+    """
+    if not _keeps_result_frames() or _instances.postponed_failures is not None:
+        return f(*args)
+
+    clean_failure = vars(failure.Failure)["cleanFailure"]
+    _instances.postponed_failures = []
+    failure.Failure.cleanFailure = _postpone_clean_failure
+    result = None
+    try:
+        result = f(*args)
+        return result
+    finally:
+        failure.Failure.cleanFailure = clean_failure
+        postponed, _instances.postponed_failures = (
+            _instances.postponed_failures,
+            None,
+        )
+        kept = None
+        if isinstance(result, defer.Deferred):
+            kept = _hold_failure(getattr(result, "result", None))
+        released = _instances.released_failures[
+            "once the test function returned"
+        ]
+        for ref in postponed:
+            postponed_failure = ref()
+            if postponed_failure is not None and postponed_failure is not kept:
+                _clean_failure(postponed_failure, released)
+
+
+def _postpone_clean_failure(self):
+    _instances.postponed_failures.append(weakref.ref(self))
+
+
+def _hold_failure(result):
+    """Keep the frames of a failure the test waited on until its teardown,
+    so that it is reported with a full traceback."""
+    if _keeps_result_frames() and isinstance(result, failure.Failure):
+        _instances.result_failures.append(weakref.ref(result))
+    return result
+
+
+def _clean_result_failures():
+    result_failures, _instances.result_failures = (
+        _instances.result_failures,
+        [],
+    )
+    released = _instances.released_failures["after their test"]
+    for ref in result_failures:
+        f = ref()
+        if f is not None:
+            _clean_failure(f, released)
+
+
+def _clean_failure(f, released):
+    if f.pickled:
+        return
+
+    tb = f.tb
+    while tb is not None:
+        released[1] += 1
+        released[2] += sum(
+            sys.getsizeof(value) for value in tb.tb_frame.f_locals.values()
+        )
+        tb = tb.tb_next
+    released[0] += 1
+    f.cleanFailure()
+
+
+def _restore_clean_failure():
+    if _instances._clean_failure_original is None:
+        return
+
+    failure.Failure.cleanFailure = _instances._clean_failure_original
+    _instances._clean_failure_original = None
+
+
+def _record_timing(phase, seconds):
+    if _timings.current is not None:
+        _timings.current[phase] = _timings.current.get(phase, 0.0) + seconds
+
+
+def _record_dispatch(seconds):
+    _record_timing("dispatch", seconds)
+    dispatches = _instances.dispatches
+    dispatches[0] += 1
+    dispatches[1] += seconds
+    dispatches[2] = max(dispatches[2], seconds)
+
+
 def stop_twisted_greenlet():
+    _drop_concurrent_tests()
     if _instances.gr_twisted:
-        _instances.reactor.stop()
+        _unfrozen(_instances.reactor, "stop")()
         _instances.gr_twisted.switch()
+    _restore_clean_failure()
 
     _instances.gr_twisted = None
     _instances.reactor = None
+    _instances.reactor_scope_key = None
+    _instances._reactor_original_calls = None
 
     _set_system_reactor(_instances._reactor_original)
 
@@ -128,149 +1018,2578 @@ def _pytest_pyfunc_call(pyfuncitem):
         return testfunction(**testargs)
 
 
-def pytest_collection_modifyitems(config, items):
-    if not config.getoption("--twisted-marked-only"):
-        twisted_marker = pytest.mark.twisted()
-        for item in items:
-            item.add_marker(twisted_marker)
-
-
-def pytest_runtest_setup(item):
-    if "twisted" in item.keywords and "twisted_greenlet" not in item.fixturenames:
-        # inject a twisted greenlet fixture for all twisted tests
-        item.fixturenames.append("twisted_greenlet")
+def _run_test(pyfuncitem):
+    result = _pytest_pyfunc_call(pyfuncitem)
+    if _iscoroutine(result):
+        return _coroutine_deferred(result)
+
+    return result
+
+
+def _concurrency(item):
+    marker = item.get_closest_marker("twisted_concurrent")
+    if marker is not None and marker.args:
+        limit, = marker.args
+        return limit
+    return _config.concurrency
+
+
+def _concurrent_funcargs(item):
+    """Return the arguments to call ``item`` with ahead of its own setup.
+
+    This is only possible if every fixture it uses is either a plain
+    parameter or a higher scoped fixture which is already set up, so
+    ``None`` is returned otherwise.
+    """
+    if item._isyieldedfunction():
+        return None
+
+    params = getattr(getattr(item, "callspec", None), "params", {})
+    fixtureinfo = item._fixtureinfo
+    funcargs = {}
+    for name in fixtureinfo.names_closure:
+        fixturedefs = fixtureinfo.name2fixturedefs.get(name)
+        if not fixturedefs:
+            return None
+
+        fixturedef = fixturedefs[-1]
+        cached_result = getattr(fixturedef, "cached_result", None)
+        func_name = getattr(fixturedef.func, "__name__", None)
+        if name in params and func_name == "get_direct_param_fixture_func":
+            value = params[name]
+        elif fixturedef.scope == "function" or name in params:
+            return None
+        elif cached_result is None or cached_result[2] is not None:
+            # not set up yet, or its setup failed
+            return None
+        else:
+            value = cached_result[0]
+
+        if name in fixtureinfo.argnames:
+            funcargs[name] = value
+
+    return funcargs
+
+
+def _run_concurrent_test(item, funcargs):
+    result = item.obj(**funcargs)
+    if _iscoroutine(result):
+        return _coroutine_deferred(result)
+
+    return result
+
+
+def _may_run_concurrently(following, item):
+    if following.parent is not item.parent:
+        return False
+    if "twisted" not in following.keywords:
+        return False
+    if _item_reactor_name(following) != _item_reactor_name(item):
+        return False
+    if _concurrency(following) <= 1:
+        return False
+    if _item_timeout(following) is not None:
+        # its deadline covers its whole body when it is called in its turn
+        return False
+    if following.get_closest_marker("twisted_loopback") is not None:
+        return False
+    return not any(
+        name in following.keywords for name in ("skip", "skipif", "xfail")
+    )
 
 
-def pytest_pyfunc_call(pyfuncitem):
-    if "twisted" not in pyfuncitem.keywords:
-        return
+def _records_per_test():
+    """Whether the plugin records anything per test, which a test started
+    ahead of its turn would add to the one running at the time."""
+    return any(
+        (
+            _config.dirty_reactor != "off",
+            _config.io_stats is not None,
+            _config.trace_callbacks is not None,
+            _config.profile_dir is not None,
+            _instances.stall_detector is not None,
+            _instances.loopback is not None,
+            _timings.items is not None,
+        )
+    )
 
-    del sys.modules['twisted.internet.reactor']
 
-    _config.reactor_installer()
-    import twisted.internet.reactor
-    _instances.reactor = twisted.internet.reactor
-    _instances.reactor._is_pytest_twisted = True
-    _set_system_reactor(_instances.reactor)
-    init_twisted_greenlet()
+def _captures_output(config):
+    """Whether pytest captures the output or log records of each test,
+    which for a test started ahead of its turn would end up in the report
+    of the one running at the time."""
+    if config.getoption("capture", "no") != "no":
+        return True
+    return config.pluginmanager.has_plugin("logging-plugin")
 
-    if _instances.gr_twisted is not None:
-        if _instances.gr_twisted.dead:
-            raise RuntimeError("twisted reactor has stopped")
 
-        def in_reactor(d, f, *args):
-            return defer.maybeDeferred(f, *args).chainDeferred(d)
+def _start_concurrent_tests(item):
+    """Start the tests following ``item`` until ``_concurrency(item)`` tests
+    are waiting on the reactor at once."""
+    limit = _concurrency(item)
+    if limit <= 1 or _config.xdist_worker_id is not None:
+        # xdist workers do not run session.items in order
+        return
+    if _records_per_test() or _captures_output(item.config):
+        return
 
-        d = defer.Deferred()
-        _instances.reactor.callLater(
-            0.0, in_reactor, d, _pytest_pyfunc_call, pyfuncitem
-        )
-        blockon_default(d)
-    else:
-        if not _instances.reactor.running:
-            raise RuntimeError("twisted reactor is not running")
-        blockingCallFromThread(
-            _instances.reactor, _pytest_pyfunc_call, pyfuncitem
+    items = item.session.items
+    if _instances.item_positions is None:
+        _instances.item_positions = {
+            following: index for index, following in enumerate(items)
+        }
+
+    in_flight = 1 + len(_instances.concurrent)
+    for following in items[_instances.item_positions[item] + 1:]:
+        if in_flight >= limit:
+            break
+        if following in _instances.concurrent:
+            continue
+        if not _may_run_concurrently(following, item):
+            break
+
+        funcargs = _concurrent_funcargs(following)
+        if funcargs is None:
+            break
+
+        _instances.concurrent[following] = _keeping_result_frames(
+            defer.maybeDeferred, _run_concurrent_test, following, funcargs
         )
-    return True
+        in_flight += 1
 
 
-@pytest.fixture
-def twisted_greenlet(request):
-    request.addfinalizer(stop_twisted_greenlet)
-    return _instances.gr_twisted
+def _drop_concurrent_tests():
+    concurrent = list(_instances.concurrent.values())
+    _instances.concurrent.clear()
+    for d in concurrent:
+        d.addErrback(lambda _: None)
+        d.cancel()
 
 
-def init_default_reactor():
-    import twisted.internet.default
+# names which make --twisted-auto-mark mark the tests of a fixture using one
+blocking_helpers = frozenset(
+    ("blockon", "blockon_all", "blockon_each", "block_from_thread")
+)
 
-    module = inspect.getmodule(twisted.internet.default.install)
 
-    module_name = module.__name__.split(".")[-1]
-    reactor_type_name, = (x for x in dir(module) if x.lower() == module_name)
-    reactor_type = getattr(module, reactor_type_name)
+def _uses_twisted(item):
+    if _uses_twisted_directly(getattr(item, "obj", None)):
+        return True
 
-    _install_reactor(
-        reactor_installer=twisted.internet.default.install,
-        reactor_type=reactor_type,
-    )
+    fixtureinfo = getattr(item, "_fixtureinfo", None)
+    if fixtureinfo is None:
+        return False
 
+    for name in fixtureinfo.names_closure:
+        if name == "twisted_greenlet":
+            return True
+        for fixturedef in fixtureinfo.name2fixturedefs.get(name, ()):
+            func = fixturedef.func
+            if _uses_twisted_directly(func) or _calls_blocking_helper(func):
+                return True
 
-def init_qt5_reactor():
-    import qt5reactor
+    return False
 
-    _install_reactor(
-        reactor_installer=qt5reactor.install, reactor_type=qt5reactor.QtReactor
-    )
 
+def _calls_blocking_helper(func):
+    code = getattr(func, "__code__", None)
+    if code is None:
+        return False
+    return not blocking_helpers.isdisjoint(code.co_names)
 
-def init_asyncio_reactor():
-    from twisted.internet import asyncioreactor
 
-    _install_reactor(
-        reactor_installer=asyncioreactor.install,
-        reactor_type=asyncioreactor.AsyncioSelectorReactor,
-    )
+def _uses_twisted_directly(func):
+    return _is_async_fixture(func)
 
 
-reactor_installers = {
-    "default": init_default_reactor,
-    "qt5reactor": init_qt5_reactor,
-    "asyncio": init_asyncio_reactor,
-}
+def pytest_collection_modifyitems(config, items):
+    _group_items_by_reactor(items)
+    if config.getoption("--twisted-marked-only"):
+        return
 
+    auto_mark = config.getoption("--twisted-auto-mark")
+    twisted_marker = pytest.mark.twisted()
+    for item in items:
+        if not auto_mark or _uses_twisted(item):
+            item.add_marker(twisted_marker)
 
-def _install_reactor(reactor_installer, reactor_type):
-    try:
-        reactor_installer()
-    except error.ReactorAlreadyInstalledError:
-        import twisted.internet.reactor
 
-        if not isinstance(twisted.internet.reactor, reactor_type):
-            raise WrongReactorAlreadyInstalledError(
-                "expected {} but found {}".format(
-                    reactor_type, type(twisted.internet.reactor)
+def _item_reactor_name(item):
+    # the twisted marker added to every test has no reactor of its own
+    for marker in item.iter_markers("twisted"):
+        if "reactor" in marker.kwargs:
+            return marker.kwargs["reactor"]
+    return _config.reactor_name
+
+
+def _group_items_by_reactor(items):
+    """Move the tests selecting another reactor with
+    ``pytest.mark.twisted(reactor=...)`` behind the others, grouped by
+    reactor, so that the reactor type changes as rarely as possible."""
+    names = {}
+    for item in items:
+        name = names[item] = _item_reactor_name(item)
+        if name == _config.reactor_name:
+            continue
+
+        if name not in reactor_installers:
+            raise pytest.UsageError(
+                "{} selects unknown reactor {!r}, expected one of {}".format(
+                    item.nodeid, name, ", ".join(sorted(reactor_installers))
+                )
+            )
+        _reactor_installer(name)
+        if _config.driver == "thread":
+            raise pytest.UsageError(
+                "{} selects reactor {!r}, but --twisted-driver=thread runs "
+                "every test with --reactor={}".format(
+                    item.nodeid, name, _config.reactor_name
+                )
+            )
+        if {name, _config.reactor_name} & set(session_reactors):
+            raise pytest.UsageError(
+                "{} selects reactor {!r}, but only one of {} and {} can be "
+                "installed per session".format(
+                    item.nodeid, name, name, _config.reactor_name
                 )
             )
 
+    order = {_config.reactor_name: 0}
+    for item in items:
+        order.setdefault(names[item], len(order))
+    if len(order) > 1:
+        items.sort(key=lambda item: order[names[item]])
+
+
+def _parse_duration(value):
+    """Parse durations like ``50ms``, ``1.5s`` or ``2`` into seconds."""
+    value = value.strip()
+    for suffix, scale in (("ms", 0.001), ("s", 1.0)):
+        if value.endswith(suffix):
+            return float(value[:-len(suffix)]) * scale
+    return float(value)
+
+
+class _StallDetector(object):
+    """Watch the reactor for callbacks which hold it longer than
+    ``threshold`` seconds.
+
+    While the twisted greenlet runs, a heartbeat is scheduled on the
+    reactor every ``threshold / 4`` seconds.  A watchdog thread captures
+    the stack of the reactor thread whenever a heartbeat is overdue by
+    more than ``threshold``.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.interval = threshold / 4.0
+        self.stalls = []
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        self._expected = None
+        self._stack = None
+        self._thread_ident = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._watch, name="pytest-twisted stall detector"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def arm(self, reactor):
+        self._thread_ident = threading.current_thread().ident
+        self._schedule(reactor)
+
+    def disarm(self):
+        if self._heartbeat is None:
+            return
+
+        if self._heartbeat.active():
+            self._heartbeat.cancel()
+        self._heartbeat = None
+        self._check()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _schedule(self, reactor):
+        with self._lock:
+            self._expected = _clock() + self.interval
+        self._heartbeat = reactor.callLater(
+            self.interval, self._beat, reactor
+        )
 
-def pytest_addoption(parser):
-    group = parser.getgroup("twisted")
-    group.addoption(
-        "--reactor",
-        default="default",
-        choices=tuple(reactor_installers.keys()),
-    )
-    group.addoption(
-        "--twisted-marked-only",
-        action="store_true",
-        default=False,
-        help="start twisted reactor only for tests marked with `pytest.mark.twisted`",
+    def _beat(self, reactor):
+        self._check()
+        self._schedule(reactor)
+
+    def _check(self):
+        with self._lock:
+            late = _clock() - self._expected
+            stack = self._stack
+            self._expected = self._stack = None
+
+        if late >= self.threshold:
+            self.stalls.append((late, stack))
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                if self._expected is None or self._stack is not None:
+                    continue
+                if _clock() - self._expected < self.threshold:
+                    continue
+
+                frame = sys._current_frames().get(self._thread_ident)
+                if frame is not None:
+                    self._stack = traceback.extract_stack(frame)
+
+
+class _GreenletProfiler(object):
+    """Profile every greenlet with its own ``cProfile.Profile``.
+
+    A single profiler would see the switches between the test greenlet and
+    the twisted greenlet as calls returning into the wrong frames, so the
+    time spent in reactor callbacks would be attributed to ``switch()``.
+    """
+
+    def __init__(self):
+        self._profiles = {}
+        self._previous_trace = None
+
+    def _profile(self, gr):
+        if gr not in self._profiles:
+            self._profiles[gr] = cProfile.Profile()
+        return self._profiles[gr]
+
+    def _trace(self, event, args):
+        if event in ("switch", "throw"):
+            origin, target = args
+            self._profile(origin).disable()
+            self._profile(target).enable()
+        if self._previous_trace is not None:
+            self._previous_trace(event, args)
+
+    def start(self):
+        self._previous_trace = greenlet.settrace(self._trace)
+        self._profile(greenlet.getcurrent()).enable()
+
+    def stop(self):
+        greenlet.settrace(self._previous_trace)
+        for profile in self._profiles.values():
+            profile.disable()
+        stats = pstats.Stats(*self._profiles.values())
+        self._profiles.clear()
+        return stats
+
+
+def _profile_path(name, extension):
+    return os.path.join(
+        _config.profile_dir,
+        re.sub(r"[^\w.-]+", "_", name).strip("_") + extension,
     )
 
 
-def pytest_configure(config):
-    pytest.inlineCallbacks = _deprecate(
-        deprecated='pytest.inlineCallbacks',
-        recommended='pytest_twisted.inlineCallbacks',
-    )(inlineCallbacks)
-    pytest.blockon = _deprecate(
-        deprecated='pytest.blockon',
-        recommended='pytest_twisted.blockon',
-    )(blockon)
+def _dump_profile(stats, name):
+    stats.dump_stats(_profile_path(name, ".pstats"))
+    try:
+        from pyprof2calltree import convert
+    except ImportError:
+        return
+    convert(stats, _profile_path(name, ".callgrind"))
 
-    _config.reactor_installer = reactor_installers[config.getoption("reactor")]
-    _config.reactor_installer()
-    _freeze_reactor()
 
+def _stop_profiler(item):
+    profiler, _instances.profiler = _instances.profiler, None
+    stats = profiler.stop()
+    _dump_profile(stats, item.nodeid)
+    if _instances.session_profile is None:
+        _instances.session_profile = stats
+    else:
+        _instances.session_profile.add(stats)
+
+
+_sources = {}
+
+
+def _source(filename):
+    # the module a file belongs to, whether it is the .py or the .pyc
+    source = _sources.get(filename)
+    if source is None:
+        source = _sources[filename] = os.path.splitext(
+            os.path.abspath(filename)
+        )[0]
+    return source
+
+
+_defer_source = _source(defer.__file__)
+# the reactor's own callbacks, e.g. for its system event triggers
+_reactor_source = _source(
+    importlib.import_module("twisted.internet.base").__file__
+)
+_plugin_source = _source(__file__)
+# callbacks and errbacks which only pass the result on
+_untraced_callbacks = tuple(
+    getattr(defer, name)
+    for name in ("passthru", "_failthru")
+    if hasattr(defer, name)
+)
+# recent Twisted versions add these callbacks directly instead of going
+# through Deferred.addCallbacks, so they have to be traced on their own
+_direct_add_callbacks = tuple(
+    name
+    for name in ("addCallback", "addErrback", "addBoth")
+    if "addCallbacks" not in vars(defer.Deferred)[name].__code__.co_names
+)
+
+
+class _CallbackTracer(object):
+    """Time the callbacks and errbacks added to deferreds while tracing.
+
+    They are wrapped by ``Deferred.addCallbacks`` and, where they do not go
+    through it, by ``addCallback``, ``addErrback`` and ``addBoth``.  The time
+    of a callback excludes the traced callbacks it runs itself, e.g. by
+    firing another deferred, and its depth is the number of traced callbacks
+    it runs within.
+    """
+
+    def __init__(self):
+        # (callback, where it was added) -> [calls, seconds, longest, depth]
+        self.callbacks = {}
+        # per deferred: [callbacks run, seconds, depth, where first added]
+        self.chains = []
+        # time spent in the traced callbacks run by the running ones
+        self._nested = []
+        # the patched Deferred methods, by name
+        self._originals = {}
+
+    def start(self):
+        self._originals = dict(
+            (name, vars(defer.Deferred)[name])
+            for name in ("addCallbacks",) + _direct_add_callbacks
+        )
+        add_callbacks = self._originals["addCallbacks"]
+
+        def addCallbacks(deferred, callback, errback=None, *args, **kwargs):
+            callback, errback = self._traced(
+                deferred,
+                sys._getframe(1),
+                (callback, errback),
+                kwargs.get("callbackArgs") or (),
+            )
+            return add_callbacks(deferred, callback, errback, *args, **kwargs)
+
+        defer.Deferred.addCallbacks = addCallbacks
+        for name in _direct_add_callbacks:
+            setattr(defer.Deferred, name, self._tracing(self._originals[name]))
+
+    def stop(self):
+        for name, original in self._originals.items():
+            setattr(defer.Deferred, name, original)
+
+    def _tracing(self, add):
+        # addCallback, addErrback and addBoth take a single callable, which
+        # addBoth uses as both callback and errback
+        def traced(deferred, f, *args, **kwargs):
+            f, = self._traced(deferred, sys._getframe(1), (f,), args)
+            return add(deferred, f, *args, **kwargs)
+
+        traced.__name__ = add.__name__
+        return traced
+
+    def _traced(self, deferred, frame, callbacks, args=()):
+        """Return ``callbacks`` wrapped for tracing, unless this plugin adds
+        them where ``frame`` runs."""
+        site = _callback_site(frame)
+        if site is None:
+            return callbacks
+        chain = getattr(deferred, "_pytest_twisted_chain", None)
+        if chain is None:
+            chain = deferred._pytest_twisted_chain = [0, 0.0, 0, site]
+            self.chains.append(chain)
+        return tuple(
+            f if f is None else self._wrap(f, site, chain, args)
+            for f in callbacks
+        )
 
-def _freeze_reactor():
+    def _wrap(self, f, site, chain, args):
+        if f in _untraced_callbacks or _is_reactor_callback(f):
+            return f
+        name, site = _describe_callback(f, site, args)
+        return functools.partial(_traced_call, self, f, name, site, chain)
+
+    def _record(self, name, site, chain, depth, elapsed):
+        own = elapsed - self._nested.pop()
+        if self._nested:
+            self._nested[-1] += elapsed
+
+        stats = self.callbacks.setdefault((name, site), [0, 0.0, 0.0, 0])
+        stats[0] += 1
+        stats[1] += own
+        stats[2] = max(stats[2], own)
+        stats[3] = max(stats[3], depth)
+        chain[0] += 1
+        chain[1] += own
+        chain[2] = max(chain[2], depth)
+
+
+def _is_reactor_callback(f):
+    code = getattr(getattr(f, "__func__", f), "__code__", None)
+    return code is not None and _source(code.co_filename) == _reactor_source
+
+
+def _traced_call(tracer, f, name, site, chain, *args, **kwargs):
+    # a plain function called through functools.partial, so that
+    # _callback_site() only has this one frame to skip
+    depth = len(tracer._nested)
+    tracer._nested.append(0.0)
+    start = _clock()
+    try:
+        return f(*args, **kwargs)
+    finally:
+        tracer._record(name, site, chain, depth, _clock() - start)
 
-    def __dont__(*args, **kwargs):
-        raise ValueError("Don't touch the reactor outside `@pytest.mark.twisted`, "
-                         "please!")
 
-    import twisted.internet
+def _callback_site(frame):
+    """Return the line adding a callback outside of ``twisted.internet.defer``
+    or ``None`` if this plugin adds it."""
+    while frame is not None and _in_deferred_machinery(frame):
+        frame = frame.f_back
+    if frame is None or _source(frame.f_code.co_filename) == _plugin_source:
+        return None
+
+    return "{}:{}".format(frame.f_code.co_filename, frame.f_lineno)
+
+
+def _in_deferred_machinery(frame):
+    if frame.f_code is _traced_call.__code__:
+        return True
+    return _source(frame.f_code.co_filename) == _defer_source
+
+
+def _closure_values(f):
+    values = []
+    for cell in getattr(f, "__closure__", None) or ():
+        try:
+            values.append(cell.cell_contents)
+        except ValueError:
+            pass
+    return values
+
+
+def _describe_callback(f, site, args=()):
+    """Return the name of a callback and where it was added.
+
+    inlineCallbacks and ensureDeferred resume their generator or coroutine
+    from a closure or, in recent Twisted versions, a callback given it as an
+    argument, which is described by the ``yield`` or ``await`` it waits at
+    instead.
+    """
+    for value in _closure_values(f) + list(args):
+        frame = getattr(value, "gi_frame", None) or getattr(
+            value, "cr_frame", None
+        )
+        if frame is not None:
+            return (
+                "resuming {}".format(frame.f_code.co_name),
+                "{}:{}".format(frame.f_code.co_filename, frame.f_lineno),
+            )
+
+    func = getattr(f, "__func__", f)
+    name = getattr(func, "__qualname__", None) or getattr(
+        func, "__name__", repr(func)
+    )
+    code = getattr(func, "__code__", None)
+    if code is not None:
+        name = "{} ({}:{})".format(
+            name, code.co_filename, code.co_firstlineno
+        )
+    return name, site
+
+
+def _stop_callback_tracer(item):
+    tracer, _instances.callback_tracer = _instances.callback_tracer, None
+    tracer.stop()
+    if not tracer.callbacks:
+        return
+
+    count = _config.trace_callbacks or None
+    hottest = sorted(
+        (
+            {
+                "callback": name,
+                "added_at": site,
+                "calls": calls,
+                "seconds": seconds,
+                "longest": longest,
+                "depth": depth,
+            }
+            for (name, site), (calls, seconds, longest, depth) in (
+                tracer.callbacks.items()
+            )
+        ),
+        key=lambda stats: stats["seconds"],
+        reverse=True,
+    )[:count]
+    longest_chains = sorted(
+        (
+            {
+                "added_at": site,
+                "callbacks": calls,
+                "seconds": seconds,
+                "depth": depth,
+            }
+            for calls, seconds, depth, site in tracer.chains
+            if calls
+        ),
+        key=lambda chain: (chain["callbacks"], chain["depth"]),
+        reverse=True,
+    )[:count]
+    seconds = sum(stats[1] for stats in tracer.callbacks.values())
+    calls = sum(stats[0] for stats in tracer.callbacks.values())
+    item.user_properties.append(
+        (
+            "twisted_callbacks",
+            {
+                "calls": calls,
+                "seconds": seconds,
+                "hottest": hottest,
+                "longest_chains": longest_chains,
+            },
+        )
+    )
+    _instances.callback_traces[item.nodeid] = (
+        seconds, calls, hottest, longest_chains
+    )
+
+
+def _format_stall(late, stack, threshold):
+    if not stack:
+        return "reactor stalled for {:.3f}s (threshold {:.3f}s)\n".format(
+            late, threshold
+        )
+
+    filename, lineno, name, _ = stack[-1]
+    return (
+        "reactor stalled for {:.3f}s (threshold {:.3f}s) in {} ({}:{})\n"
+        "{}".format(
+            late,
+            threshold,
+            name,
+            filename,
+            lineno,
+            "".join(traceback.format_list(stack)),
+        )
+    )
+
+
+def _observe_unhandled_error(event):
+    # Deferreds garbage collected with an unhandled failure log it here
+    if event.get("log_namespace") != "twisted.internet.defer":
+        return
+    if "log_failure" in event:
+        _instances.unhandled_errors.append(event["log_failure"])
+
+
+def _check_dirty_reactor(item):
+    if _instances.concurrent:
+        # the leftovers may belong to the tests started ahead of their turn
+        return
+
+    gc.collect()
+    unhandled_errors, _instances.unhandled_errors = (
+        _instances.unhandled_errors, []
+    )
+    if _instances.reactor is None:
+        leftovers = ([], [], [])
+    else:
+        leftovers = _reactor_leftovers(_instances.reactor)
+    if not (any(leftovers) or unhandled_errors):
+        return
+
+    _instances.dirty_reactors[item.nodeid] = tuple(
+        len(x) for x in leftovers + (unhandled_errors,)
+    )
+    lines = ["reactor left dirty by {}".format(item.nodeid)]
+    if _instances.reactor is not None:
+        lines.append(_describe_reactor(_instances.reactor))
+    lines.append("unhandled errors in garbage collected deferreds:")
+    lines.extend(
+        "    {}".format(f.getErrorMessage()) for f in unhandled_errors
+    )
+    if not unhandled_errors:
+        lines.append("    none")
+    message = "\n".join(lines)
+
+    if _config.dirty_reactor == "error":
+        raise DirtyReactorError(message)
+    warnings.warn(DirtyReactorWarning(message))
+
+
+def _clean_scoped_reactor(item):
+    """Cancel the calls and remove the readers and writers ``item`` left on
+    the reactor the next test reuses, which may be the one test modules
+    imported, so it is not replaced."""
+    reactor = _instances.reactor
+    calls, readers, writers = _reactor_leftovers(reactor)
+    if not (calls or readers or writers):
+        return
+
+    if _config.dirty_reactor == "off":
+        # otherwise _check_dirty_reactor() reported it already
+        warnings.warn(
+            DirtyReactorWarning(
+                "reactor left dirty by {}, cleaned up for the next test\n"
+                "{}".format(item.nodeid, _describe_reactor(reactor))
+            )
+        )
+    for call in calls:
+        call.cancel()
+    for reader in readers:
+        reactor.removeReader(reader)
+    for writer in writers:
+        reactor.removeWriter(writer)
+
+
+def _reactor_scope(item):
+    if _item_reactor_name(item) in session_reactors:
+        return "session"
+    if _instances.reactor_thread is not None:
+        # the thread keeps running the reactor it started with
+        return "session"
+
+    marker = item.get_closest_marker("twisted_reactor_scope")
+    if marker is None:
+        return _config.reactor_scope
+
+    scope, = marker.args
+    if scope not in reactor_scopes:
+        raise ValueError(
+            "unknown twisted reactor scope {!r}, expected one of {}".format(
+                scope, ", ".join(reactor_scopes)
+            )
+        )
+    return scope
+
+
+def _reactor_scope_key(item):
+    scope = _reactor_scope(item)
+    reactor_name = _item_reactor_name(item)
+    if scope == "function":
+        return scope, item.nodeid, reactor_name
+    elif scope == "module":
+        return scope, item.fspath, reactor_name
+    return scope, None, reactor_name
+
+
+def _reactor_leftovers(reactor):
+    # some reactors list their own wakers as readers
+    internal = getattr(reactor, "_internalReaders", ())
+    return (
+        reactor.getDelayedCalls(),
+        [r for r in reactor.getReaders() if r not in internal],
+        [w for w in reactor.getWriters() if w not in internal],
+    )
+
+
+def _install_test_reactor(item):
+    scope_key = _reactor_scope_key(item)
+    scope, _, reactor_name = scope_key
+
+    if reactor_name != _config.reactor_name:
+        # selected by pytest.mark.twisted(reactor=...)
+        _instances.reactor = _reinstall_reactor(
+            _reactor_installer(reactor_name)
+        )
+    elif scope == "session" and not _instances._reactor_original_used:
+        # the reactor installed at configure time is the one test modules
+        # imported, so use it while it can still be started
+        _instances._reactor_original_used = True
+        _instances.reactor = _instances._reactor_original
+    elif _instances.reactor_pool is not None:
+        _instances.reactor = _instances.reactor_pool.get()
+    else:
+        _instances.reactor = _reinstall_reactor(_config.reactor_installer)
+
+    _instances.reactor._is_pytest_twisted = True
+    original = _instances._reactor_original
+    if original is None or original is _instances.reactor:
+        _instances._reactor_original_calls = None
+    elif _shares_event_loop(original, _instances.reactor):
+        # the calls scheduled on it run while the test's reactor does
+        _instances._reactor_original_calls = None
+    else:
+        _instances._reactor_original_calls = set(original.getDelayedCalls())
+    _configure_thread_pool(_instances.reactor)
+    if _config.io_stats is not None:
+        _account_reactor_io(_instances.reactor)
+    _instances.reactor_scope_key = scope_key
+    _set_system_reactor(_instances.reactor)
+
+
+def _shares_event_loop(reactor, other):
+    loop = getattr(reactor, "_asyncioEventloop", None)
+    if loop is None:
+        return False
+    return loop is getattr(other, "_asyncioEventloop", None)
+
+
+def _reinstall_reactor(reactor_installer):
+    del sys.modules['twisted.internet.reactor']
+
+    reactor_installer()
+    import twisted.internet.reactor
+    return twisted.internet.reactor
+
+
+def _start_test_reactor(item):
+    if _instances.reactor is None:
+        start = _clock()
+        _install_test_reactor(item)
+        _record_timing("install", _clock() - start)
+    init_twisted_greenlet()
+
+
+def pytest_pyfunc_call(pyfuncitem):
+    if "twisted" not in pyfuncitem.keywords:
+        if not _config.auto_mark:
+            return
+
+        # --twisted-auto-mark did not recognize it, but it still has to wait
+        # for the deferred it returns
+        result = _keeping_result_frames(_pytest_pyfunc_call, pyfuncitem)
+        if isinstance(result, defer.Deferred):
+            pyfuncitem.add_marker("twisted")
+            _start_test_reactor(pyfuncitem)
+            blockon(result)
+        return True
+
+    _start_test_reactor(pyfuncitem)
+
+    if _instances.gr_twisted is not None:
+        if _instances.gr_twisted.dead:
+            raise RuntimeError("twisted reactor has stopped")
+
+        if pyfuncitem in _instances.concurrent:
+            # started ahead of its turn by a previous test
+            d = _instances.concurrent.pop(pyfuncitem)
+            _start_concurrent_tests(pyfuncitem)
+            blockon_default(d)
+            return True
+
+        if _config.direct_call:
+            # call the test directly, the reactor only needs to run when
+            # it returns a deferred which has not fired yet
+            result = _keeping_result_frames(_run_test, pyfuncitem)
+            _start_concurrent_tests(pyfuncitem)
+            if isinstance(result, defer.Deferred):
+                blockon_default(result)
+            return True
+
+        def in_reactor(d, f, *args):
+            _record_dispatch(_clock() - scheduled)
+            test_deferred.append(
+                _keeping_result_frames(defer.maybeDeferred, f, *args)
+            )
+            if not test_deferred[0].called:
+                try:
+                    _check_reactor_original_calls()
+                except RuntimeError:
+                    # the test would never finish, so it is cancelled
+                    d.errback()
+                    test_deferred[0].addErrback(lambda _: None)
+                    test_deferred[0].cancel()
+                    return
+            return test_deferred[0].chainDeferred(d)
+
+        def cancel(d):
+            if test_deferred:
+                test_deferred[0].cancel()
+
+        test_deferred = []
+        d = defer.Deferred(cancel)
+        scheduled = _clock()
+        _instances.reactor.callLater(0.0, in_reactor, d, _run_test, pyfuncitem)
+        _start_concurrent_tests(pyfuncitem)
+        blockon_default(d)
+    else:
+        if not _instances.reactor.running:
+            raise RuntimeError("twisted reactor is not running")
+        _call_in_reactor(
+            lambda: _with_deadline(
+                _keeping_result_frames(
+                    defer.maybeDeferred, _run_test, pyfuncitem
+                )
+            )
+        )
+    return True
+
+
+def _item_timeout(item):
+    marker = item.get_closest_marker("twisted_timeout")
+    if marker is not None:
+        timeout, = marker.args
+    else:
+        timeout = item.config.getini("twisted_timeout")
+        if not timeout:
+            return None
+
+    return _parse_duration(str(timeout))
+
+
+def _start_deadline(item):
+    _instances.timeout = _item_timeout(item)
+    if _instances.timeout is None:
+        _instances.deadline = None
+    else:
+        _instances.deadline = _clock() + _instances.timeout
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_runtest_setup(item):
+    _instances.item = item
+    if _config.profile_dir is not None:
+        _instances.profiler = _GreenletProfiler()
+        _instances.profiler.start()
+    if _config.trace_callbacks is not None:
+        _instances.callback_tracer = _CallbackTracer()
+        _instances.callback_tracer.start()
+    if _config.io_stats is not None:
+        _instances.io_stats = [0] * len(io_fields)
+    if _config.threadpool_stats:
+        _instances.thread_stats = [0, 0, 0.0, 0.0]
+    if _timings.items is not None:
+        _timings.current = _timings.items.setdefault(item.nodeid, {})
+    _start_deadline(item)
+
+    if "twisted" in item.keywords:
+        # before the fixtures, which may already use the reactor
+        _start_test_reactor(item)
+        if item.get_closest_marker("twisted_loopback") is not None:
+            _start_loopback(_instances.reactor)
+
+    if _config.dirty_reactor != "off":
+        # registered first, so it runs after all the fixture finalizers
+        item.addfinalizer(lambda: _check_dirty_reactor(item))
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_fixture_setup(fixturedef, request):
+    if _is_async_fixture(fixturedef.func) and not hasattr(
+        fixturedef.func, "_pytest_twisted_fixture"
+    ):
+        fixturedef.func = _async_fixture_wrapper(fixturedef)
+    if _reactor_driven() and _may_start_async_fixture(fixturedef):
+        _start_async_fixtures(fixturedef, request)
+
+
+def _reactor_driven():
+    # by the twisted greenlet or, with --twisted-driver=thread, its thread
+    if _instances.reactor_thread is not None:
+        return True
+    return _instances.gr_twisted is not None
+
+
+def pytest_runtest_call(item):
+    _start_deadline(item)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_teardown(item, nextitem):
+    _start_deadline(item)
+    yield
+
+    # the fixture finalizers, which may still need the reactor, ran now
+    teardown_error = None
+    if _instances.fixture_starts:
+        try:
+            _drop_async_fixture_starts()
+        except Exception as e:
+            # raised once the reactor is cleaned up
+            teardown_error = e
+    _instances.timeout = _instances.deadline = None
+    stats, _instances.thread_stats = _instances.thread_stats, None
+    if stats is not None and stats[0]:
+        calls, depth, waited, longest = stats
+        item.user_properties.append(
+            (
+                "twisted_threadpool",
+                {
+                    "calls": calls,
+                    "max_queue_depth": depth,
+                    "waited": waited,
+                    "longest_wait": longest,
+                },
+            )
+        )
+        if depth:
+            _instances.thread_queues[item.nodeid] = stats
+    if _instances.result_failures:
+        _clean_result_failures()
+    try:
+        if _instances.reactor is None or _instances.reactor_thread is not None:
+            return
+
+        if nextitem is not None and nextitem in _instances.concurrent:
+            # keep the reactor the next test is already running on
+            return
+
+        if nextitem is not None:
+            scope_key = _reactor_scope_key(nextitem)
+            if scope_key == _instances.reactor_scope_key:
+                _clean_scoped_reactor(item)
+                return
+
+        start = _clock()
+        stop_twisted_greenlet()
+        _record_timing("teardown", _clock() - start)
+    finally:
+        _timings.current = None
+        _instances.item = None
+        if _instances.profiler is not None:
+            _stop_profiler(item)
+        if _instances.callback_tracer is not None:
+            _stop_callback_tracer(item)
+        if _instances.io_stats is not None:
+            _record_io(item)
+        if _instances.loopback is not None:
+            _stop_loopback(item)
+        if teardown_error is not None:
+            raise teardown_error
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    outcome = yield
+    detector = _instances.stall_detector
+    if detector is None or not detector.stalls:
+        return
+
+    report = outcome.get_result()
+    stalls, detector.stalls = detector.stalls, []
+    report.sections.append(
+        (
+            "Captured twisted stalls {}".format(call.when),
+            "\n".join(
+                _format_stall(late, stack, detector.threshold)
+                for late, stack in stalls
+            ),
+        )
+    )
+    _instances.stalls.setdefault(item.nodeid, []).extend(stalls)
+
+
+def pytest_terminal_summary(terminalreporter):
+    if _instances.stalls:
+        _summarize_stalls(terminalreporter)
+
+    if _instances.dirty_reactors:
+        _summarize_dirty_reactors(terminalreporter)
+
+    if _instances.thread_queues:
+        _summarize_thread_queues(terminalreporter)
+
+    if _instances.callback_traces:
+        _summarize_callback_traces(terminalreporter)
+
+    if _instances.io_tests:
+        _summarize_io(terminalreporter)
+
+    if _instances.loopback_fallbacks:
+        _summarize_loopback_fallbacks(terminalreporter)
+
+    count = terminalreporter.config.getoption("twisted_durations")
+    if _instances.dispatches[0] and count is not None:
+        _summarize_dispatches(terminalreporter)
+
+    if _config.failure_frames == "result" and not _cleans_failures:
+        terminalreporter.write_sep("=", "twisted failure frames")
+        terminalreporter.write_line(
+            "twisted {} does not clean failures, --twisted-failure-frames "
+            "has no effect".format(twisted.__version__)
+        )
+    elif any(r[0] for r in _instances.released_failures.values()):
+        terminalreporter.write_sep("=", "twisted failure frames")
+        for when, released in _instances.released_failures.items():
+            if released[0]:
+                terminalreporter.write_line(
+                    "twisted {}: cleaned {} failure(s) {}, releasing {} "
+                    "frame(s) with {} bytes of locals".format(
+                        twisted.__version__, released[0], when, *released[1:]
+                    )
+                )
+
+    if _timings.items is not None and count is not None:
+        if _timings.workers:
+            _summarize_worker_timings(terminalreporter)
+        _summarize_timings(terminalreporter, count)
+
+
+def _summarize_worker_timings(terminalreporter):
+    terminalreporter.write_sep("=", "twisted reactor overhead per worker")
+    for worker_id, totals in _timings.workers.items():
+        terminalreporter.write_line(
+            "{}: {} tests configure={:.4f}s {}".format(
+                worker_id,
+                totals["tests"],
+                totals["configure"],
+                " ".join(
+                    "{}={:.4f}s".format(phase, totals.get(phase, 0.0))
+                    for phase in timing_phases
+                ),
+            )
+        )
+
+
+def _summarize_callback_traces(terminalreporter):
+    traces = sorted(
+        _instances.callback_traces.items(),
+        key=lambda trace: trace[1][0],
+        reverse=True,
+    )
+    count = _config.trace_callbacks
+    if count:
+        traces = traces[:count]
+        title = "slowest {} twisted callback traces".format(count)
+    else:
+        title = "slowest twisted callback traces"
+
+    terminalreporter.write_sep("=", title)
+    for nodeid, (seconds, calls, hottest, longest_chains) in traces:
+        terminalreporter.write_line(
+            "{:.4f}s in {} callback(s) {}".format(seconds, calls, nodeid)
+        )
+        terminalreporter.write_line("  hottest callbacks:")
+        for stats in hottest:
+            terminalreporter.write_line(
+                "    {seconds:.4f}s {calls} call(s), longest {longest:.4f}s, "
+                "depth {depth}: {callback} from {added_at}".format(**stats)
+            )
+        terminalreporter.write_line("  longest chains:")
+        for chain in longest_chains:
+            terminalreporter.write_line(
+                "    {callbacks} callback(s) {seconds:.4f}s, depth {depth}: "
+                "deferred from {added_at}".format(**chain)
+            )
+
+
+def _summarize_dispatches(terminalreporter):
+    calls, total, longest = _instances.dispatches
+    terminalreporter.write_sep("=", "twisted dispatch latency")
+    terminalreporter.write_line(
+        "{} driver: {} call(s), mean {:.6f}s, longest {:.6f}s".format(
+            _config.driver, calls, total / calls, longest
+        )
+    )
+
+
+def _summarize_dirty_reactors(terminalreporter):
+    totals = [sum(x) for x in zip(*_instances.dirty_reactors.values())]
+    terminalreporter.write_sep("=", "twisted dirty reactors")
+    terminalreporter.write_line(
+        "{} test(s) left {} delayed call(s), {} reader(s), {} writer(s) "
+        "and {} unhandled error(s) behind".format(
+            len(_instances.dirty_reactors), *totals
+        )
+    )
+
+
+def _summarize_stalls(terminalreporter):
+    threshold = _instances.stall_detector.threshold
+    terminalreporter.write_sep(
+        "=", "twisted reactor stalls over {:.3f}s".format(threshold)
+    )
+    for nodeid, stalls in _instances.stalls.items():
+        terminalreporter.write_line(
+            "{} stall(s), longest {:.3f}s {}".format(
+                len(stalls), max(late for late, _ in stalls), nodeid
+            )
+        )
+
+
+def _summarize_timings(terminalreporter, count):
+    overheads = sorted(
+        (
+            (sum(phases.get(phase, 0.0) for phase in timing_phases), nodeid)
+            for nodeid, phases in _timings.items.items()
+        ),
+        reverse=True,
+    )
+    if count:
+        overheads = overheads[:count]
+        title = "slowest {} twisted reactor overheads".format(count)
+    else:
+        title = "slowest twisted reactor overheads"
+
+    terminalreporter.write_sep("=", title)
+    for total, nodeid in overheads:
+        phases = _timings.items[nodeid]
+        terminalreporter.write_line(
+            "{:.4f}s {} {}".format(
+                total,
+                " ".join(
+                    "{}={:.4f}s".format(phase, phases.get(phase, 0.0))
+                    for phase in timing_phases
+                ),
+                nodeid,
+            )
+        )
+
+
+def pytest_sessionfinish(session):
+    if _instances.session_profile is not None:
+        name = "session"
+        if _config.xdist_worker_id is not None:
+            name += "-" + _config.xdist_worker_id
+        _dump_profile(_instances.session_profile, name)
+
+    if _timings.items is None:
+        return
+
+    if _config.xdist_worker_id is not None:
+        # handed to the controller in pytest_testnodedown
+        session.config.workeroutput["pytest_twisted_timings"] = {
+            "configure": _timings.configure,
+            "items": list(_timings.items.items()),
+        }
+        return
+
+    path = session.config.getoption("twisted_durations_json")
+    if path is None:
+        return
+
+    with open(path, "w") as f:
+        json.dump(
+            [
+                dict(nodeid=nodeid, **phases)
+                for nodeid, phases in _timings.items.items()
+            ],
+            f,
+            indent=2,
+        )
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):
+    output = getattr(node, "workeroutput", None) or {}
+    timings = output.get("pytest_twisted_timings")
+    if timings is None or _timings.items is None:
+        return
+
+    totals = collections.OrderedDict(
+        [("tests", len(timings["items"])), ("configure", timings["configure"])]
+    )
+    for nodeid, phases in timings["items"]:
+        _timings.items[nodeid] = phases
+        for phase in timing_phases:
+            totals[phase] = totals.get(phase, 0.0) + phases.get(phase, 0.0)
+    _timings.workers[node.gateway.id] = totals
+
+
+def _xdist_worker_id(config):
+    workerinput = getattr(config, "workerinput", None)
+    if workerinput is None:
+        return None
+
+    return workerinput["workerid"]
+
+
+def pytest_unconfigure(config):
+    if _instances.reactor is not None:
+        stop_twisted_greenlet()
+
+    if _instances.reactor_thread is not None:
+        _instances.reactor_thread.stop()
+        _instances.reactor_thread = None
+
+    if _instances.reactor_pool is not None:
+        _instances.reactor_pool.drain()
+        _instances.reactor_pool = None
+
+    if _instances.stall_detector is not None:
+        _instances.stall_detector.stop()
+        _instances.stall_detector = None
+
+    if _instances.threadpool is not None:
+        _instances.threadpool.stop()
+        _instances.threadpool = None
+
+    if _instances.uvloop is not None:
+        _instances.uvloop.close()
+        _instances.uvloop = None
+
+    if _config.dirty_reactor != "off":
+        from twisted.logger import globalLogPublisher
+
+        globalLogPublisher.removeObserver(_observe_unhandled_error)
+
+
+@pytest.fixture
+def twisted_greenlet(request):
+    return _instances.gr_twisted
+
+
+@pytest.fixture
+def twisted_loopback(request):
+    """Connect the test's TCP and UNIX clients to its servers in memory."""
+    if _instances.reactor is None:
+        request.node.add_marker("twisted")
+        _start_test_reactor(request.node)
+    return _start_loopback(_instances.reactor)
+
+
+# reactor name -> reactor type, resolved once per session
+_reactor_types = {}
+
+
+def _default_reactor_type():
+    if "default" in _reactor_types:
+        return _reactor_types["default"]
+
+    import twisted.internet.default
+
+    module = inspect.getmodule(twisted.internet.default.install)
+
+    module_name = module.__name__.split(".")[-1]
+    reactor_type_name, = (x for x in dir(module) if x.lower() == module_name)
+    _reactor_types["default"] = getattr(module, reactor_type_name)
+    return _reactor_types["default"]
+
+
+def init_default_reactor():
+    import twisted.internet.default
+
+    _install_reactor(
+        reactor_installer=twisted.internet.default.install,
+        reactor_type=_default_reactor_type(),
+    )
+
+
+# reactor type -> its virtual time subclass
+_virtual_time_reactor_types = {}
+
+
+def _virtual_time_reactor_type(base):
+    """Return a subclass of ``base`` whose clock jumps to the next delayed
+    call whenever the reactor would otherwise sleep without any I/O or
+    thread it could be waiting for, like ``twisted.internet.task.Clock``
+    being advanced by hand.
+    """
+    if base in _virtual_time_reactor_types:
+        return _virtual_time_reactor_types[base]
+
+    from twisted.internet.base import DelayedCall
+    from twisted.python import log
+    from twisted.python.runtime import seconds
+
+    class VirtualTimeReactor(base):
+        _virtual_offset = 0.0
+
+        def __init__(self):
+            self._wall_clock_calls = []
+            base.__init__(self)
+
+        def seconds(self):
+            return seconds() + self._virtual_offset
+
+        def _callLaterWallClock(self, delay, f, *args, **kw):
+            # like callLater, but the virtual time never runs it early,
+            # e.g. for the plugin's own timeouts
+            call = DelayedCall(
+                _clock() + delay,
+                f,
+                args,
+                kw,
+                self._wall_clock_calls.remove,
+                lambda call: None,
+                seconds=_clock,
+            )
+            self._wall_clock_calls.append(call)
+            return call
+
+        def doIteration(self, delay):
+            if delay and self._idle():
+                self._virtual_offset += delay
+                delay = 0
+            if self._wall_clock_calls:
+                nearest = min(c.getTime() for c in self._wall_clock_calls)
+                wait = max(nearest - _clock(), 0)
+                delay = wait if delay is None else min(delay, wait)
+            base.doIteration(self, delay)
+            self._runWallClockCalls()
+
+        def _runWallClockCalls(self):
+            now = _clock()
+            for call in list(self._wall_clock_calls):
+                if call.getTime() <= now and call.active():
+                    self._wall_clock_calls.remove(call)
+                    call.called = 1
+                    try:
+                        call.func(*call.args, **call.kw)
+                    except Exception:
+                        log.err(None, "Unhandled error in wall clock call")
+
+        def _idle(self):
+            internal = getattr(self, "_internalReaders", ())
+            if self.getWriters() or any(
+                reader not in internal for reader in self.getReaders()
+            ):
+                return False
+            if self.threadCallQueue:
+                return False
+            pool = self.threadpool
+            return pool is None or not (pool.working or pool.q.qsize())
+
+    VirtualTimeReactor.__name__ = "VirtualTime" + base.__name__
+    _virtual_time_reactor_types[base] = VirtualTimeReactor
+    return VirtualTimeReactor
+
+
+def init_clock_reactor():
+    from twisted.internet.main import installReactor
+
+    reactor_type = _virtual_time_reactor_type(_default_reactor_type())
+    _install_reactor(
+        reactor_installer=lambda: installReactor(reactor_type()),
+        reactor_type=reactor_type,
+    )
+
+
+def init_qt5_reactor():
+    try:
+        import qt5reactor
+    except ImportError:
+        raise pytest.UsageError(
+            "--reactor=qt5reactor requires qt5reactor to be installed"
+        )
+
+    _install_reactor(
+        reactor_installer=qt5reactor.install, reactor_type=qt5reactor.QtReactor
+    )
+
+
+def init_asyncio_reactor():
+    from twisted.internet import asyncioreactor
+
+    _install_reactor(
+        reactor_installer=asyncioreactor.install,
+        reactor_type=asyncioreactor.AsyncioSelectorReactor,
+    )
+
+
+def init_asyncio_uvloop_reactor():
+    try:
+        import uvloop
+    except ImportError:
+        raise pytest.UsageError(
+            "--reactor=asyncio-uvloop requires uvloop to be installed"
+        )
+
+    import asyncio
+
+    from twisted.internet import asyncioreactor
+
+    loop = _instances.uvloop
+    if loop is None or loop.is_closed():
+        # uvloop's policy does not create a loop in get_event_loop() since
+        # 0.18, so each reinstalled reactor builds on this one
+        loop = _instances.uvloop = uvloop.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    try:
+        _install_reactor(
+            reactor_installer=lambda: asyncioreactor.install(eventloop=loop),
+            reactor_type=asyncioreactor.AsyncioSelectorReactor,
+        )
+    except WrongReactorAlreadyInstalledError:
+        raise
+    except Exception as e:
+        raise pytest.UsageError(
+            "--reactor=asyncio-uvloop is not available: {}".format(e)
+        )
+
+
+def _twisted_reactor_module(module_name):
+    return importlib.import_module("twisted.internet." + module_name)
+
+
+def _init_twisted_reactor(name, module_name, reactor_type_name):
+    try:
+        module = _twisted_reactor_module(module_name)
+    except ImportError as e:
+        # e.g. kqueue outside of BSD and macOS, or gi without PyGObject
+        raise pytest.UsageError(
+            "--reactor={} is not available: {}".format(name, e)
+        )
+    _install_reactor(
+        reactor_installer=module.install,
+        reactor_type=getattr(module, reactor_type_name),
+    )
+
+
+def init_epoll_reactor():
+    _init_twisted_reactor("epoll", "epollreactor", "EPollReactor")
+
+
+def init_kqueue_reactor():
+    _init_twisted_reactor("kqueue", "kqreactor", "KQueueReactor")
+
+
+def init_poll_reactor():
+    _init_twisted_reactor("poll", "pollreactor", "PollReactor")
+
+
+def init_select_reactor():
+    _init_twisted_reactor("select", "selectreactor", "SelectReactor")
+
+
+def init_gi_reactor():
+    _init_twisted_reactor("gi", "gireactor", "GIReactor")
+
+
+reactor_installers = {
+    "default": init_default_reactor,
+    "qt5reactor": init_qt5_reactor,
+    "asyncio": init_asyncio_reactor,
+    "asyncio-uvloop": init_asyncio_uvloop_reactor,
+    "clock": init_clock_reactor,
+    "epoll": init_epoll_reactor,
+    "kqueue": init_kqueue_reactor,
+    "poll": init_poll_reactor,
+    "select": init_select_reactor,
+    "gi": init_gi_reactor,
+}
+
+# reactors which can be constructed off the main thread
+poolable_reactors = ["default", "clock", "epoll", "kqueue", "poll", "select"]
+
+# reactors which cannot be installed again, so all tests share one
+session_reactors = []
+
+# reactors which have to run in the main thread, so not with
+# --twisted-driver=thread
+main_thread_reactors = ["qt5reactor", "gi"]
+
+# --reactor=auto picks the first of these which is available, fastest first
+auto_reactors = (
+    ("epoll", "epollreactor"),
+    ("kqueue", "kqreactor"),
+    ("poll", "pollreactor"),
+    ("select", "selectreactor"),
+)
+
+reactor_entry_point_group = "pytest_twisted.reactors"
+
+# name -> entry point of the reactors registered by other packages which
+# were not selected so far, their installers are loaded on first use
+reactor_entry_points = {}
+
+
+def _reactor_entry_points():
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:  # Python <3.8
+        try:
+            import pkg_resources
+        except ImportError:
+            return []
+        return list(pkg_resources.iter_entry_points(reactor_entry_point_group))
+
+    found = entry_points()
+    if hasattr(found, "select"):
+        return list(found.select(group=reactor_entry_point_group))
+    return list(found.get(reactor_entry_point_group, ()))
+
+
+def _register_reactor_entry_points():
+    """Add the names of the reactors other packages provide through entry
+    points, without importing anything before one of them is selected.
+
+    An entry point names the reactor and refers to its installer, which
+    may declare ``poolable = True`` if the reactor can be constructed off
+    the main thread, ``reinstallable = False`` if only one reactor can
+    be installed per process and ``main_thread = True`` if the reactor
+    has to run in the main thread.
+    """
+    for entry_point in _reactor_entry_points():
+        if entry_point.name in reactor_installers:
+            continue
+
+        reactor_installers[entry_point.name] = None
+        reactor_entry_points[entry_point.name] = entry_point
+
+
+def _reactor_installer(name):
+    """Return the installer of reactor ``name``, loading it first if it is
+    provided by an entry point."""
+    entry_point = reactor_entry_points.pop(name, None)
+    if entry_point is None:
+        return reactor_installers[name]
+
+    installer = reactor_installers[name] = entry_point.load()
+    if getattr(installer, "poolable", False):
+        poolable_reactors.append(name)
+    if not getattr(installer, "reinstallable", True):
+        session_reactors.append(name)
+    if getattr(installer, "main_thread", False):
+        main_thread_reactors.append(name)
+    return installer
+
+
+def _resolve_reactor_name(name):
+    if name != "auto":
+        return name
+
+    for reactor_name, module_name in auto_reactors:
+        try:
+            _twisted_reactor_module(module_name)
+        except ImportError:
+            continue
+        return reactor_name
+
+    return "default"
+
+
+class _ReactorPool(object):
+    """Build reactors of ``reactor_type`` in a background thread so that
+    per-test isolation does not pay for their construction.
+    """
+
+    def __init__(self, reactor_type, depth):
+        self._reactor_type = reactor_type
+        self._reactors = queue.Queue(maxsize=depth)
+        self._draining = threading.Event()
+        self._thread = threading.Thread(
+            target=self._fill, name="pytest-twisted reactor pool"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fill(self):
+        while not self._draining.is_set():
+            try:
+                reactor = self._reactor_type()
+            except Exception:
+                # e.g. EMFILE from the selector or the waker pipe, which
+                # get() raises rather than waiting for a reactor forever
+                self._reactors.put(failure.Failure())
+                return
+            self._reactors.put(reactor)
+
+    def get(self):
+        if self._reactors.empty() and not self._thread.is_alive():
+            # the pool gave up after failing to build a reactor
+            return self._reactor_type()
+
+        reactor = self._reactors.get()
+        if isinstance(reactor, failure.Failure):
+            reactor.raiseException()
+        return reactor
+
+    def drain(self):
+        self._draining.set()
+        while self._thread.is_alive():
+            try:
+                self._dispose(self._reactors.get(timeout=0.1))
+            except queue.Empty:
+                pass
+
+        while not self._reactors.empty():
+            self._dispose(self._reactors.get_nowait())
+
+    @staticmethod
+    def _dispose(reactor):
+        if not isinstance(reactor, failure.Failure):
+            _dispose_reactor(reactor)
+
+
+class _ReactorThread(object):
+    """Run ``reactor`` in a background thread for --twisted-driver=thread.
+
+    Calls are queued without a lock and the reactor is only woken up for
+    the first call queued since it last ran them, instead of once per call
+    as by ``blockingCallFromThread``.  The caller waits on a plain lock
+    rather than a ``Queue``.
+    """
+
+    def __init__(self, reactor):
+        self._reactor = reactor
+        self._calls = collections.deque()
+        self._wakeup_pending = False
+        running = threading.Event()
+        reactor.callWhenRunning(running.set)
+        self._thread = threading.Thread(
+            target=_unfrozen(reactor, "run"),
+            kwargs={"installSignalHandlers": False},
+            name="pytest-twisted reactor",
+        )
+        self._thread.daemon = True
+        self._thread.start()
+        running.wait()
+
+    def call(self, f, *args):
+        """Call ``f`` in the reactor thread and wait for the deferred it
+        returns, if any, to fire."""
+        assert (
+            not self.is_current()
+        ), "blockon cannot be called from the reactor thread"
+        done = threading.Lock()
+        done.acquire()
+        result = []
+        self._calls.append((_clock(), f, args, done, result))
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            self._reactor.callFromThread(self._run_calls)
+        done.acquire()
+
+        fired, r = result
+        _record_timing("resume", _clock() - fired)
+        if isinstance(r, failure.Failure):
+            r.raiseException()
+        return r
+
+    def is_current(self):
+        return threading.current_thread() is self._thread
+
+    def _run_calls(self):
+        # reset first, calls queued from now on need another wakeup
+        self._wakeup_pending = False
+        while self._calls:
+            queued, f, args, done, result = self._calls.popleft()
+            _record_dispatch(_clock() - queued)
+            defer.maybeDeferred(f, *args).addBoth(self._fired, done, result)
+
+    @staticmethod
+    def _fired(r, done, result):
+        result.extend((_clock(), r))
+        done.release()
+
+    def stop(self):
+        self._reactor.callFromThread(_unfrozen(self._reactor, "stop"))
+        self._thread.join()
+
+
+class _InstrumentedThreadPool(ThreadPool):
+    """A thread pool recording how long calls wait for a free worker."""
+
+    def __init__(self, *args, **kwargs):
+        ThreadPool.__init__(self, *args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._queued = 0
+
+    def callInThreadWithCallback(self, onResult, func, *args, **kw):
+        queued = _clock()
+        with self._stats_lock:
+            stats = _instances.thread_stats
+            if stats is not None:
+                stats[0] += 1
+                stats[1] = max(stats[1], self._queued)
+            self._queued += 1
+
+        def run():
+            waited = _clock() - queued
+            with self._stats_lock:
+                self._queued -= 1
+                if stats is not None:
+                    stats[2] += waited
+                    stats[3] = max(stats[3], waited)
+            return func(*args, **kw)
+
+        ThreadPool.callInThreadWithCallback(self, onResult, run)
+
+
+def _new_thread_pool():
+    if _config.threadpool_stats:
+        pool_type = _InstrumentedThreadPool
+    else:
+        pool_type = ThreadPool
+    return pool_type(
+        _config.threadpool_minthreads,
+        _config.threadpool_maxthreads,
+        "twisted.internet.reactor",
+    )
+
+
+def _configure_thread_pool(reactor):
+    if reactor.threadpool is not None:
+        # already in use, e.g. by a conftest.py
+        return
+    if not _config.threadpool_stats and _instances.threadpool is None:
+        sizes = _config.threadpool_minthreads, _config.threadpool_maxthreads
+        if sizes == (0, 10):
+            # the reactor creates the same thread pool by itself
+            return
+
+    def init():
+        # like ReactorBase._initThreadPool(), which creates it on first use
+        if _instances.threadpool is not None:
+            reactor.threadpool = _instances.threadpool
+            return
+
+        reactor.threadpool = _new_thread_pool()
+        reactor.callWhenRunning(reactor.threadpool.start)
+        reactor.threadpoolShutdownID = reactor.addSystemEventTrigger(
+            "during", "shutdown", reactor._stopThreadPool
+        )
+
+    reactor._initThreadPool = init
+
+
+def _count_io(field, amount=1):
+    if _instances.io_stats is not None:
+        _instances.io_stats[io_fields.index(field)] += amount
+
+
+def _counting_io(method, field):
+    @functools.wraps(method)
+    def counted(*args, **kwargs):
+        _count_io(field)
+        return method(*args, **kwargs)
+
+    return counted
+
+
+def _account_reactor_io(reactor):
+    """Count the I/O of the selectables added to ``reactor`` from now on and
+    its iterations, into the I/O of the test running at the time."""
+    if getattr(reactor, "_pytest_twisted_io", False):
+        return
+
+    reactor._pytest_twisted_io = True
+    for name in ("addReader", "addWriter"):
+        add = getattr(reactor, name)
+        setattr(reactor, name, _accounting_add(add))
+    do_iteration = getattr(reactor, "doIteration", None)
+    if do_iteration is not None:
+        # asyncio based reactors have no iterations of their own
+        reactor.doIteration = _counting_io(do_iteration, "iterations")
+
+
+def _accounting_add(add):
+    @functools.wraps(add)
+    def accounting_add(selectable):
+        if not getattr(selectable, "_pytest_twisted_io", False):
+            _account_selectable_io(selectable)
+        return add(selectable)
+
+    return accounting_add
+
+
+def _account_selectable_io(selectable):
+    from twisted.internet import interfaces
+
+    # by switching its class, as e.g. tcp.Client replaces and deletes the
+    # doRead and doWrite of the instance itself while connecting
+    try:
+        selectable.__class__ = _io_accounting_type(type(selectable))
+    except TypeError:
+        return
+
+    if interfaces.ITransport.providedBy(
+        selectable
+    ) and not interfaces.IListeningPort.providedBy(selectable):
+        _count_io("connections")
+
+
+_io_accounting_types = {}
+
+
+def _io_accounting_type(base):
+    io_type = _io_accounting_types.get(base)
+    if io_type is not None:
+        return io_type
+
+    namespace = {"__module__": base.__module__, "_pytest_twisted_io": True}
+    for name, field in (
+        ("doRead", "do_read"),
+        ("doWrite", "do_write"),
+        ("write", "write_calls"),
+        ("writeSequence", "write_calls"),
+    ):
+        if hasattr(base, name):
+            namespace[name] = _counting_io(getattr(base, name), field)
+
+    if hasattr(base, "writeSomeData"):
+        write_some_data = base.writeSomeData
+
+        @functools.wraps(write_some_data)
+        def writeSomeData(self, data):
+            written = write_some_data(self, data)
+            if isinstance(written, int):
+                _count_io("bytes_written", written)
+            return written
+
+        namespace["writeSomeData"] = writeSomeData
+
+    # stream connections hand what they read to _dataReceived()
+    if hasattr(base, "_dataReceived"):
+        data_received = base._dataReceived
+
+        @functools.wraps(data_received)
+        def _dataReceived(self, data):
+            _count_io("bytes_read", len(data))
+            return data_received(self, data)
+
+        namespace["_dataReceived"] = _dataReceived
+
+    io_type = _io_accounting_types[base] = type(
+        base.__name__, (base,), namespace
+    )
+    return io_type
+
+
+def _record_io(item):
+    stats, _instances.io_stats = _instances.io_stats, None
+    if not any(stats[:io_fields.index("iterations")]):
+        # the reactor merely ran
+        return
+
+    item.user_properties.append(("twisted_io", dict(zip(io_fields, stats))))
+    _instances.io_tests[item.nodeid] = stats
+
+
+def _summarize_io(terminalreporter):
+    tests = sorted(
+        _instances.io_tests.items(),
+        # reads and writes first
+        key=lambda test: test[1][3] + test[1][4] + test[1][5],
+        reverse=True,
+    )
+    count = _config.io_stats
+    if count:
+        tests = tests[:count]
+        title = "most twisted I/O of {} tests".format(count)
+    else:
+        title = "twisted I/O per test"
+
+    terminalreporter.write_sep("=", title)
+    for nodeid, stats in tests:
+        terminalreporter.write_line(
+            "{connections} connection(s), {bytes_read} byte(s) read in "
+            "{do_read} doRead(s), {bytes_written} byte(s) written in "
+            "{do_write} doWrite(s) for {write_calls} write(s), {iterations} "
+            "iteration(s) {nodeid}".format(
+                nodeid=nodeid, **dict(zip(io_fields, stats))
+            )
+        )
+
+
+def _is_loopback_host(host):
+    return host in ("localhost", "::1") or host.startswith("127.")
+
+
+class _LoopbackNetwork(object):
+    """Connect the TCP and UNIX clients of ``reactor`` to its servers in
+    memory, with the transports and pumping of ``twisted.test.iosim``.
+
+    Everything else, like clients of servers this network does not know
+    about, is passed on to the reactor itself and recorded in
+    ``fallbacks``.
+    """
+
+    methods = ("listenTCP", "connectTCP", "listenUNIX", "connectUNIX")
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.fallbacks = []
+        # (type, port or path) -> _LoopbackPort
+        self._ports = {}
+        self._port_numbers = iter(range(49152, 65536))
+
+    def install(self):
+        for name in self.methods:
+            setattr(self.reactor, name, getattr(self, name))
+
+    def uninstall(self):
+        for name in self.methods:
+            vars(self.reactor).pop(name, None)
+
+    def _fallback(self, name, destination, reason, *args, **kwargs):
+        self.fallbacks.append(
+            "{}({}): {}".format(name, destination, reason)
+        )
+        return getattr(type(self.reactor), name)(self.reactor, *args, **kwargs)
+
+    def _listen(self, key, factory, address):
+        if key in self._ports:
+            raise error.CannotListenError(
+                getattr(address, "host", None),
+                key[1],
+                "address already in use by the loopback network",
+            )
+        port = self._ports[key] = _LoopbackPort(self, key, factory, address)
+        factory.doStart()
+        return port
+
+    def listenTCP(self, port, factory, backlog=50, interface=""):
+        from twisted.internet import address
+
+        if interface not in ("", "0.0.0.0", "::") and not _is_loopback_host(
+            interface
+        ):
+            return self._fallback(
+                "listenTCP",
+                "{}:{}".format(interface, port),
+                "not a loopback interface",
+                port,
+                factory,
+                backlog,
+                interface,
+            )
+
+        if not port:
+            port = next(self._port_numbers)
+        if ":" in interface:
+            host = address.IPv6Address("TCP", interface, port)
+        else:
+            host = address.IPv4Address("TCP", interface or "0.0.0.0", port)
+        return self._listen(("TCP", port), factory, host)
+
+    def connectTCP(self, host, port, factory, timeout=30, bindAddress=None):
+        from twisted.internet import address
+
+        server = self._ports.get(("TCP", port))
+        if server is None or not _is_loopback_host(host):
+            return self._fallback(
+                "connectTCP",
+                "{}:{}".format(host, port),
+                "no loopback server listening",
+                host,
+                port,
+                factory,
+                timeout,
+                bindAddress,
+            )
+
+        address_type = address.IPv6Address if ":" in host else (
+            address.IPv4Address
+        )
+        return _LoopbackConnector(
+            self,
+            server,
+            factory,
+            address_type("TCP", host, next(self._port_numbers)),
+            address_type("TCP", host, port),
+        )
+
+    def listenUNIX(self, address, factory, backlog=50, mode=0o666, wantPID=0):
+        from twisted.internet.address import UNIXAddress
+
+        return self._listen(("UNIX", address), factory, UNIXAddress(address))
+
+    def connectUNIX(self, address, factory, timeout=30, checkPID=0):
+        from twisted.internet.address import UNIXAddress
+
+        server = self._ports.get(("UNIX", address))
+        if server is None:
+            return self._fallback(
+                "connectUNIX",
+                address,
+                "no loopback server listening",
+                address,
+                factory,
+                timeout,
+                checkPID,
+            )
+
+        return _LoopbackConnector(
+            self, server, factory, UNIXAddress(None), UNIXAddress(address)
+        )
+
+
+class _LoopbackPort(object):
+    def __init__(self, network, key, factory, address):
+        from twisted.internet import interfaces
+        from zope.interface import directlyProvides
+
+        directlyProvides(self, interfaces.IListeningPort)
+        self._network = network
+        self._key = key
+        self.factory = factory
+        self._address = address
+
+    def startListening(self):
+        pass
+
+    def stopListening(self):
+        if self._network._ports.get(self._key) is self:
+            del self._network._ports[self._key]
+            self.factory.doStop()
+        return defer.succeed(None)
+
+    loseConnection = stopListening
+
+    def getHost(self):
+        return self._address
+
+
+class _LoopbackConnector(object):
+    """Connect ``factory`` to ``server`` on the next reactor iteration,
+    like a real connector would."""
+
+    def __init__(self, network, server, factory, host, peer):
+        self._network = network
+        self._server = server
+        self.factory = factory
+        self._host = host
+        self._peer = peer
+        self.state = "disconnected"
+        self._connecting = None
+        self.connect()
+
+    def connect(self):
+        self.state = "connecting"
+        self.factory.doStart()
+        self.factory.startedConnecting(self)
+        self._connecting = self._network.reactor.callLater(0, self._connect)
+
+    def _connect(self):
+        from twisted.test import iosim
+
+        self._connecting = None
+        server = self._server.factory.buildProtocol(self._host)
+        client = self.factory.buildProtocol(self._peer)
+        if server is None or client is None:
+            self._failed(error.ConnectionRefusedError())
+            return
+
+        server_transport = iosim.FakeTransport(
+            server, True, self._peer, self._host
+        )
+        client_transport = iosim.FakeTransport(
+            client, False, self._host, self._peer
+        )
+        pump = _LoopbackPump(
+            self._network.reactor,
+            iosim.IOPump(client, server, client_transport, server_transport,
+                         False),
+        )
+        for transport in (server_transport, client_transport):
+            for name in ("write", "loseConnection", "abortConnection"):
+                setattr(
+                    transport, name, pump.scheduling(getattr(transport, name))
+                )
+        report_disconnect = client_transport.reportDisconnect
+
+        def reportDisconnect():
+            report_disconnect()
+            self.state = "disconnected"
+            self.factory.clientConnectionLost(
+                self, failure.Failure(client_transport.disconnectReason)
+            )
+            self.factory.doStop()
+
+        client_transport.reportDisconnect = reportDisconnect
+        self.transport = client_transport
+        self.state = "connected"
+        server.makeConnection(server_transport)
+        client.makeConnection(client_transport)
+        pump.schedule()
+
+    def _failed(self, reason):
+        self.state = "disconnected"
+        self.factory.clientConnectionFailed(self, failure.Failure(reason))
+        self.factory.doStop()
+
+    def stopConnecting(self):
+        if self.state != "connecting":
+            raise error.NotConnectingError()
+        self._connecting.cancel()
+        self._failed(error.UserError())
+
+    def disconnect(self):
+        if self.state == "connecting":
+            self.stopConnecting()
+        elif self.state == "connected":
+            self.transport.loseConnection()
+
+    def getDestination(self):
+        return self._peer
+
+
+class _LoopbackPump(object):
+    """Run an ``iosim.IOPump`` from the reactor whenever one of its
+    transports wrote or disconnected, at most 100 rounds at a time."""
+
+    def __init__(self, reactor, pump):
+        self._reactor = reactor
+        self._pump = pump
+        self._call = None
+        self._pumping = False
+
+    def scheduling(self, method):
+        @functools.wraps(method)
+        def scheduling(*args, **kwargs):
+            result = method(*args, **kwargs)
+            self.schedule()
+            return result
+
+        return scheduling
+
+    def schedule(self):
+        if self._call is None and not self._pumping:
+            self._call = self._reactor.callLater(0, self._run)
+
+    def _run(self):
+        self._call = None
+        self._pumping = True
+        try:
+            for _ in range(100):
+                if not self._pump.pump():
+                    return
+        finally:
+            self._pumping = False
+        # more to move, let the reactor run other calls first
+        self.schedule()
+
+
+def _start_loopback(reactor):
+    if _instances.loopback is None:
+        _instances.loopback = _LoopbackNetwork(reactor)
+        _instances.loopback.install()
+    return _instances.loopback
+
+
+def _stop_loopback(item):
+    loopback, _instances.loopback = _instances.loopback, None
+    loopback.uninstall()
+    if loopback.fallbacks:
+        item.user_properties.append(
+            ("twisted_loopback_fallbacks", loopback.fallbacks)
+        )
+        _instances.loopback_fallbacks[item.nodeid] = loopback.fallbacks
+
+
+def _summarize_loopback_fallbacks(terminalreporter):
+    terminalreporter.write_sep("=", "twisted loopback fallbacks")
+    for nodeid, fallbacks in _instances.loopback_fallbacks.items():
+        terminalreporter.write_line(nodeid)
+        for fallback in fallbacks:
+            terminalreporter.write_line("    " + fallback)
+
+
+def _summarize_thread_queues(terminalreporter):
+    terminalreporter.write_sep("=", "twisted thread pool queueing")
+    for nodeid, (calls, depth, waited, longest) in sorted(
+        _instances.thread_queues.items(), key=lambda x: -x[1][2]
+    ):
+        terminalreporter.write_line(
+            "{} call(s), max queue depth {}, waited {:.4f}s, longest "
+            "{:.4f}s {}".format(calls, depth, waited, longest, nodeid)
+        )
+
+
+def _dispose_reactor(reactor):
+    # release the file descriptors of a reactor which never ran
+    for reader in list(getattr(reactor, "_internalReaders", ())):
+        reader.connectionLost(failure.Failure(error.ConnectionDone()))
+
+    close = getattr(getattr(reactor, "_poller", None), "close", None)
+    if close is not None:
+        close()
+
+
+def _install_reactor(reactor_installer, reactor_type):
+    try:
+        reactor_installer()
+    except error.ReactorAlreadyInstalledError:
+        import twisted.internet.reactor
+
+        if not isinstance(twisted.internet.reactor, reactor_type):
+            raise WrongReactorAlreadyInstalledError(
+                "expected {} but found {}".format(
+                    reactor_type, type(twisted.internet.reactor)
+                )
+            )
+
+
+def pytest_addoption(parser):
+    _register_reactor_entry_points()
+
+    group = parser.getgroup("twisted")
+    group.addoption(
+        "--reactor",
+        default="default",
+        choices=tuple(reactor_installers.keys()) + ("auto",),
+    )
+    group.addoption(
+        "--twisted-marked-only",
+        action="store_true",
+        default=False,
+        help="start twisted reactor only for tests marked with `pytest.mark.twisted`",
+    )
+    group.addoption(
+        "--twisted-auto-mark",
+        action="store_true",
+        default=False,
+        help="only run coroutine functions, tests decorated by pytest_twisted "
+        "and tests whose fixtures call blockon with the twisted reactor",
+    )
+    group.addoption(
+        "--twisted-direct-call",
+        action="store_true",
+        default=False,
+        help="call tests directly instead of from within the running "
+        "reactor, which then only runs once a test waits for a deferred",
+    )
+    group.addoption(
+        "--twisted-driver",
+        default="greenlet",
+        choices=drivers,
+        help="run the reactor in a greenlet switched to while tests wait, "
+        "or in a background thread for the whole session",
+    )
+    group.addoption(
+        "--twisted-reactor-scope",
+        default=None,
+        choices=reactor_scopes,
+        help="reuse the reactor and the twisted greenlet across tests of "
+        "this scope as long as each test leaves the reactor clean "
+        "(default: function, session on xdist workers)",
+    )
+    group.addoption(
+        "--twisted-reactor-pool",
+        type=int,
+        default=0,
+        metavar="DEPTH",
+        help="build up to DEPTH reactors ahead of time in a background thread",
+    )
+    group.addoption(
+        "--twisted-concurrency",
+        type=int,
+        default=1,
+        metavar="N",
+        help="start up to N consecutive twisted tests on the reactor at once "
+        "if they only use parameters and already set up fixtures, and "
+        "output is not captured (-s -p no:logging)",
+    )
+    group.addoption(
+        "--twisted-durations",
+        type=int,
+        default=None,
+        metavar="N",
+        help="show N tests with the most reactor overhead (N=0 for all)",
+    )
+    group.addoption(
+        "--twisted-durations-json",
+        default=None,
+        metavar="PATH",
+        help="write the reactor overhead of every test to PATH as JSON",
+    )
+    group.addoption(
+        "--twisted-profile",
+        default=None,
+        metavar="DIR",
+        help="profile every test including the reactor callbacks it causes "
+        "and write the profiles to DIR",
+    )
+    group.addoption(
+        "--twisted-trace-callbacks",
+        type=int,
+        default=None,
+        metavar="N",
+        help="time the callbacks of the deferreds used by every test and "
+        "report its N hottest callbacks and longest callback chains "
+        "(N=0 for all)",
+    )
+    group.addoption(
+        "--twisted-io-stats",
+        type=int,
+        default=None,
+        metavar="N",
+        help="count the connections, reads, writes and reactor iterations "
+        "of every test and list the N tests doing the most reads and writes "
+        "(N=0 for all)",
+    )
+    group.addoption(
+        "--twisted-threadpool-stats",
+        action="store_true",
+        default=False,
+        help="record how long calls to the reactor's thread pool wait for "
+        "a worker and list the tests whose calls had to queue",
+    )
+    group.addoption(
+        "--twisted-stall-threshold",
+        type=_parse_duration,
+        default=None,
+        metavar="DURATION",
+        help="report callbacks holding the reactor for longer than DURATION, "
+        "e.g. 50ms",
+    )
+    group.addoption(
+        "--twisted-failure-frames",
+        default="all",
+        choices=failure_frames_modes,
+        help="keep the frames of all failures while the reactor runs, only "
+        "until the test which created them finished, or not at all",
+    )
+    group.addoption(
+        "--twisted-dirty-reactor",
+        default="off",
+        choices=dirty_reactor_modes,
+        help="warn about or fail tests which leave delayed calls, readers, "
+        "writers or unhandled errors in deferreds behind",
+    )
+    parser.addini(
+        "twisted_threadpool_minthreads",
+        default="0",
+        help="minimum number of threads in the reactor's thread pool",
+    )
+    parser.addini(
+        "twisted_threadpool_maxthreads",
+        default="10",
+        help="maximum number of threads in the reactor's thread pool",
+    )
+    parser.addini(
+        "twisted_threadpool_shared",
+        type="bool",
+        default=False,
+        help="keep one warm thread pool for all test reactors",
+    )
+    parser.addini(
+        "twisted_timeout",
+        help="fail tests whose deferreds take longer than this to fire, "
+        "e.g. 30s",
+    )
+
+
+def pytest_configure(config):
+    pytest.inlineCallbacks = _deprecate(
+        deprecated='pytest.inlineCallbacks',
+        recommended='pytest_twisted.inlineCallbacks',
+    )(inlineCallbacks)
+    pytest.blockon = _deprecate(
+        deprecated='pytest.blockon',
+        recommended='pytest_twisted.blockon',
+    )(blockon)
+
+    config.addinivalue_line(
+        "markers",
+        "twisted(reactor=None): run the marked tests with the twisted "
+        "reactor, optionally with another reactor than --reactor",
+    )
+    config.addinivalue_line(
+        "markers",
+        "twisted_reactor_scope(scope): override --twisted-reactor-scope "
+        "for the marked tests",
+    )
+    config.addinivalue_line(
+        "markers",
+        "twisted_concurrent(limit): run up to limit of the marked tests on "
+        "the reactor at once, overriding --twisted-concurrency",
+    )
+    config.addinivalue_line(
+        "markers",
+        "twisted_loopback: connect the TCP and UNIX clients of the marked "
+        "tests to their servers in memory instead of through sockets",
+    )
+    config.addinivalue_line(
+        "markers",
+        "twisted_timeout(timeout): fail the marked tests if a deferred they "
+        "wait on takes longer than timeout to fire",
+    )
+
+    reactor_name = _resolve_reactor_name(config.getoption("reactor"))
+    _config.reactor_name = reactor_name
+    # the installer of a reactor from an entry point is only loaded now,
+    # the checks below need what it declares
+    _config.reactor_installer = _reactor_installer(reactor_name)
+    _config.driver = config.getoption("twisted_driver")
+    if _config.driver == "thread" and reactor_name in main_thread_reactors:
+        raise pytest.UsageError(
+            "--twisted-driver=thread is not supported with "
+            "--reactor={}".format(reactor_name)
+        )
+    _config.xdist_worker_id = _xdist_worker_id(config)
+    reactor_pool_depth = config.getoption("twisted_reactor_pool")
+    reactor_scope = config.getoption("twisted_reactor_scope")
+    if reactor_scope is None:
+        # an xdist worker keeps its reactor unless asked for fresh ones
+        if _config.xdist_worker_id is None or reactor_pool_depth:
+            reactor_scope = "function"
+        else:
+            reactor_scope = "session"
+    _config.reactor_scope = reactor_scope
+    unpoolable = reactor_pool_depth and reactor_name not in poolable_reactors
+    if unpoolable and _config.xdist_worker_id is None:
+        # already checked by the xdist controller for its workers
+        raise pytest.UsageError(
+            "--twisted-reactor-pool is not supported with --reactor={}".format(
+                reactor_name
+            )
+        )
+
+    durations = (
+        config.getoption("twisted_durations"),
+        config.getoption("twisted_durations_json"),
+    )
+    if any(option is not None for option in durations):
+        _timings.items = collections.OrderedDict()
+
+    distributed = config.getoption("dist", "no") != "no"
+    if distributed and _config.xdist_worker_id is None:
+        # the xdist controller only distributes tests, the workers each
+        # install their own reactor
+        return
+
+    _config.failure_frames = config.getoption("twisted_failure_frames")
+    _config.direct_call = config.getoption("twisted_direct_call")
+    _config.auto_mark = config.getoption(
+        "twisted_auto_mark"
+    ) and not config.getoption("twisted_marked_only")
+    _config.concurrency = config.getoption("twisted_concurrency")
+    _config.profile_dir = config.getoption("twisted_profile")
+    _config.trace_callbacks = config.getoption("twisted_trace_callbacks")
+    _config.io_stats = config.getoption("twisted_io_stats")
+    if _config.profile_dir is not None and not os.path.isdir(
+        _config.profile_dir
+    ):
+        os.makedirs(_config.profile_dir)
+    _config.threadpool_stats = config.getoption("twisted_threadpool_stats")
+    _config.threadpool_minthreads = int(
+        config.getini("twisted_threadpool_minthreads")
+    )
+    _config.threadpool_maxthreads = int(
+        config.getini("twisted_threadpool_maxthreads")
+    )
+    if config.getini("twisted_threadpool_shared"):
+        _instances.threadpool = _new_thread_pool()
+        _instances.threadpool.start()
+    _config.dirty_reactor = config.getoption("twisted_dirty_reactor")
+    if _config.dirty_reactor != "off":
+        from twisted.logger import globalLogPublisher
+
+        globalLogPublisher.addObserver(_observe_unhandled_error)
+
+    stall_threshold = config.getoption("twisted_stall_threshold")
+    if stall_threshold is not None:
+        _instances.stall_detector = _StallDetector(threshold=stall_threshold)
+
+    start = _clock()
+    _config.reactor_installer()
+    _freeze_reactor()
+    _timings.configure = _clock() - start
+
+    if _config.driver == "thread":
+        _config.external_reactor = True
+        _instances.reactor_thread = _ReactorThread(
+            _instances._reactor_original
+        )
+    elif reactor_pool_depth:
+        _instances.reactor_pool = _ReactorPool(
+            reactor_type=type(_instances._reactor_original),
+            depth=reactor_pool_depth,
+        )
+
+
+def _freeze_reactor():
+
+    def __dont__(*args, **kwargs):
+        raise ValueError("Don't touch the reactor outside `@pytest.mark.twisted`, "
+                         "please!")
+
+    import twisted.internet
 
     twisted.internet.reactor.run = __dont__
     twisted.internet.reactor.stop = __dont__
@@ -279,6 +3598,11 @@ def _freeze_reactor():
     _instances._reactor_original = twisted.internet.reactor
 
 
+def _unfrozen(reactor, name):
+    # bypass the instance attributes set by _freeze_reactor()
+    return getattr(type(reactor), name).__get__(reactor)
+
+
 def _set_system_reactor(reactor):
     import twisted.internet
     twisted.internet.reactor = reactor
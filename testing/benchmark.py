@@ -0,0 +1,452 @@
+"""Measure the per-test overhead of pytest-twisted for each reactor.
+
+Every scenario is written to a temporary directory and run in a separate
+pytest process, once with a single test and once with ``--count`` tests.
+The difference in wall clock time divided by the additional number of
+tests is the cost of a single test, independent of the startup of pytest
+and of the reactor.  The reactor overhead recorded by the plugin itself
+(``--twisted-durations-json``) is averaged over all tests of the larger
+run.
+
+The results are written as JSON, to stdout or to ``--output``::
+
+    python testing/benchmark.py --reactor default --count 500 -o bench.json
+
+Every reactor is run with the default greenlet driver unless ``--driver``
+asks for others, e.g. ``--driver greenlet --driver thread`` to compare
+their dispatch latency.  Reactors which cannot be installed here, e.g.
+``kqueue`` on Linux, are recorded as skipped.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+from timeit import default_timer as clock
+
+import pytest_twisted
+
+
+scenarios = {}
+
+
+def scenario(name, needs_async_await=False):
+    def register(source):
+        scenarios[name] = (textwrap.dedent(source), needs_async_await)
+
+    return register
+
+
+scenario("empty")("""
+    import pytest
+
+    @pytest.mark.parametrize("i", range(COUNT))
+    def test_empty(i):
+        pass
+""")
+
+scenario("fired_deferred")("""
+    import pytest
+    from twisted.internet import defer
+
+    @pytest.mark.parametrize("i", range(COUNT))
+    def test_fired(i):
+        return defer.succeed(i)
+""")
+
+scenario("call_later_hops")("""
+    import pytest
+    import pytest_twisted
+    from twisted.internet import task
+
+    @pytest.mark.parametrize("i", range(COUNT))
+    @pytest_twisted.inlineCallbacks
+    def test_hops(i):
+        from twisted.internet import reactor
+        for _ in range(HOPS):
+            yield task.deferLater(reactor, 0, lambda: None)
+""")
+
+scenario("coroutine_hops", needs_async_await=True)("""
+    import pytest
+    from twisted.internet import task
+
+    @pytest.mark.parametrize("i", range(COUNT))
+    async def test_hops(i):
+        from twisted.internet import reactor
+        for _ in range(HOPS):
+            await task.deferLater(reactor, 0, lambda: None)
+""")
+
+# the same hops driven by defer.ensureDeferred, which coroutine tests used
+# on every reactor before they became asyncio tasks on the asyncio reactor
+scenario("coroutine_hops_ensure_deferred", needs_async_await=True)("""
+    import pytest
+    from twisted.internet import defer, task
+
+    async def hops():
+        from twisted.internet import reactor
+        for _ in range(HOPS):
+            await task.deferLater(reactor, 0, lambda: None)
+
+    @pytest.mark.parametrize("i", range(COUNT))
+    def test_hops(i):
+        return defer.ensureDeferred(hops())
+""")
+
+scenario("asyncio_hops", needs_async_await=True)("""
+    import asyncio
+
+    import pytest
+
+    @pytest.mark.parametrize("i", range(COUNT))
+    async def test_hops(i):
+        for _ in range(HOPS):
+            await asyncio.sleep(0)
+""")
+
+scenario("asyncio_hops_ensure_deferred", needs_async_await=True)("""
+    import asyncio
+
+    import pytest
+    from twisted.internet import defer
+
+    async def hops():
+        for _ in range(HOPS):
+            await defer.Deferred.fromFuture(
+                asyncio.ensure_future(asyncio.sleep(0))
+            )
+
+    @pytest.mark.parametrize("i", range(COUNT))
+    def test_hops(i):
+        return defer.ensureDeferred(hops())
+""")
+
+scenario("blockon_fixture")("""
+    import pytest
+    import pytest_twisted
+    from twisted.internet import task
+
+    @pytest.fixture
+    def value():
+        from twisted.internet import reactor
+        return pytest_twisted.blockon(task.deferLater(reactor, 0, lambda: 1))
+
+    @pytest.mark.parametrize("i", range(COUNT))
+    def test_blockon(i, value):
+        assert value == 1
+""")
+
+scenario("block_from_thread")("""
+    import pytest
+    import pytest_twisted
+    from twisted.internet import task
+
+    @pytest.fixture
+    def value():
+        from twisted.internet import reactor
+        return pytest_twisted.blockon(task.deferLater(reactor, 0, lambda: 1))
+
+    @pytest.mark.parametrize("i", range(COUNT))
+    def test_block_from_thread(i, value):
+        assert value == 1
+""")
+
+scenario("tcp_echo")("""
+    import pytest
+    import pytest_twisted
+    from twisted.internet import defer, endpoints, protocol
+    from twisted.protocols import wire
+
+    MESSAGE = b"x" * 64
+
+    class Client(protocol.Protocol):
+        def __init__(self):
+            self.received = 0
+            self.done = defer.Deferred()
+
+        def connectionMade(self):
+            self.transport.write(MESSAGE)
+
+        def dataReceived(self, data):
+            self.received += len(data)
+            if self.received >= len(MESSAGE) * HOPS:
+                self.transport.loseConnection()
+                self.done.callback(None)
+            elif self.received % len(MESSAGE) == 0:
+                self.transport.write(MESSAGE)
+
+    @pytest.mark.parametrize("i", range(COUNT))
+    @pytest_twisted.inlineCallbacks
+    def test_echo(i):
+        from twisted.internet import reactor
+        port = reactor.listenTCP(
+            0, protocol.Factory.forProtocol(wire.Echo), interface="127.0.0.1"
+        )
+        endpoint = endpoints.TCP4ClientEndpoint(
+            reactor, "127.0.0.1", port.getHost().port
+        )
+        client = yield endpoints.connectProtocol(endpoint, Client())
+        yield client.done
+        yield port.stopListening()
+""")
+
+# runs pytest in a thread of an already running reactor, see
+# test_pytest_from_reactor_thread
+external_runner = textwrap.dedent("""
+    import sys
+
+    import pytest
+    import pytest_twisted
+    from twisted.internet import reactor
+    from twisted.internet.threads import deferToThread
+
+    codes = []
+
+    def main():
+        d = deferToThread(pytest.main, sys.argv[1:])
+        d.addBoth(codes.append)
+        # the plugin froze reactor.stop() while pytest ran
+        d.addBoth(lambda _: pytest_twisted._unfrozen(reactor, "stop")())
+
+    if __name__ == "__main__":
+        reactor.callLater(0, main)
+        reactor.run()
+        sys.exit(codes[0])
+""")
+
+
+# installs the reactor given as argument, to see whether it is available
+reactor_probe = textwrap.dedent("""
+    import sys
+
+    import pytest_twisted
+
+    pytest_twisted._register_reactor_entry_points()
+    pytest_twisted._reactor_installer(sys.argv[1])()
+""")
+
+
+def reactor_environment(reactor):
+    env = dict(os.environ)
+    if reactor == "qt5reactor":
+        env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    return env
+
+
+def run_pytest(directory, name, reactor, driver, count, hops, timeout):
+    source = scenarios[name][0]
+    source = source.replace("COUNT", str(count)).replace("HOPS", str(hops))
+    with open(os.path.join(directory, "test_bench.py"), "w") as f:
+        f.write(source)
+
+    durations = os.path.join(directory, "durations.json")
+    if os.path.exists(durations):
+        os.remove(durations)
+    args = [
+        "-q",
+        "-p", "no:cacheprovider",
+        "--twisted-durations-json={}".format(durations),
+        "test_bench.py",
+    ]
+    if name == "block_from_thread":
+        command = [sys.executable, "runner.py"] + args
+    else:
+        command = [
+            sys.executable,
+            "-m",
+            "pytest",
+            "--reactor={}".format(reactor),
+            "--twisted-driver={}".format(driver),
+        ] + args
+
+    start = clock()
+    process = subprocess.Popen(
+        command,
+        cwd=directory,
+        env=reactor_environment(reactor),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    killer = threading.Timer(timeout, process.kill)
+    killer.start()
+    try:
+        output = process.communicate()[0]
+    finally:
+        killer.cancel()
+    elapsed = clock() - start
+    if process.returncode != 0:
+        raise RuntimeError(
+            "{} with {} and the {} driver failed:\n{}".format(
+                name, reactor, driver, output.decode("utf-8", "replace")
+            )
+        )
+
+    with open(durations) as f:
+        return elapsed, json.load(f)
+
+
+def measure(directory, name, reactor, driver, count, hops, timeout):
+    single, _ = run_pytest(directory, name, reactor, driver, 1, hops, timeout)
+    elapsed, tests = run_pytest(
+        directory, name, reactor, driver, count, hops, timeout
+    )
+    phases = {
+        phase: sum(test.get(phase, 0.0) for test in tests) / len(tests)
+        for phase in pytest_twisted.timing_phases
+    }
+    return {
+        "tests": count,
+        "wall": elapsed,
+        "per_test": (elapsed - single) / max(count - 1, 1),
+        "phases": phases,
+    }
+
+
+def unavailable_reason(reactor):
+    process = subprocess.Popen(
+        [sys.executable, "-c", reactor_probe, reactor],
+        env=reactor_environment(reactor),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    output = process.communicate()[0]
+    if process.returncode == 0:
+        return None
+
+    lines = output.decode("utf-8", "replace").strip().splitlines()
+    return "reactor not available: {}".format(lines[-1] if lines else "")
+
+
+def skip_reason(name, reactor, driver):
+    needs_async_await = scenarios[name][1]
+    if needs_async_await and sys.version_info < (3, 5):
+        return "async/await syntax not supported on Python <3.5"
+    if name.startswith("asyncio_hops") and reactor != "asyncio":
+        return "awaits asyncio futures"
+    if name == "block_from_thread" and reactor != "default":
+        return "an external reactor is only benchmarked as default reactor"
+    if name == "block_from_thread" and driver != "greenlet":
+        return "an external reactor is only benchmarked once"
+    if driver == "thread" and reactor in pytest_twisted.main_thread_reactors:
+        return "reactor has to run in the main thread"
+    return None
+
+
+def run(reactors, drivers, names, count, hops, timeout):
+    directory = tempfile.mkdtemp(prefix="pytest-twisted-benchmark-")
+    try:
+        with open(os.path.join(directory, "runner.py"), "w") as f:
+            f.write(external_runner)
+
+        results = []
+        for reactor in reactors:
+            unavailable = unavailable_reason(reactor)
+            for driver in drivers:
+                for name in names:
+                    result = {
+                        "reactor": reactor, "driver": driver, "scenario": name
+                    }
+                    reason = unavailable or skip_reason(name, reactor, driver)
+                    if reason is not None:
+                        result["skipped"] = reason
+                        status = reason
+                    else:
+                        result.update(
+                            measure(
+                                directory, name, reactor, driver,
+                                count, hops, timeout,
+                            )
+                        )
+                        status = "{:.6f}s per test".format(result["per_test"])
+                    results.append(result)
+                    print(
+                        "{reactor} {driver} {scenario}: {status}".format(
+                            status=status, **result
+                        ),
+                        file=sys.stderr,
+                    )
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+def main(argv=None):
+    # so that reactors from entry points can be chosen as well
+    pytest_twisted._register_reactor_entry_points()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--reactor",
+        action="append",
+        choices=sorted(pytest_twisted.reactor_installers),
+        help="reactor to benchmark, may be given more than once "
+        "(default: all, those which are not available are skipped)",
+    )
+    parser.add_argument(
+        "--driver",
+        action="append",
+        choices=pytest_twisted.drivers,
+        help="driver to run the reactor with, may be given more than once "
+        "(default: greenlet)",
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(scenarios),
+        help="scenario to run, may be given more than once (default: all)",
+    )
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument(
+        "--hops",
+        type=int,
+        default=10,
+        help="callLater(0) hops awaited by the *_hops scenarios and round "
+        "trips of the tcp_echo scenario",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=300.0,
+        help="seconds after which a pytest run is killed, which fails the "
+        "benchmark",
+    )
+    parser.add_argument("-o", "--output", help="write the JSON results here")
+    args = parser.parse_args(argv)
+
+    try:
+        results = run(
+            args.reactor or sorted(pytest_twisted.reactor_installers),
+            args.driver or ["greenlet"],
+            args.scenario or sorted(scenarios),
+            args.count,
+            args.hops,
+            args.timeout,
+        )
+    except RuntimeError as e:
+        parser.exit(1, "{}\n".format(e))
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "count": args.count,
+        "hops": args.hops,
+        "results": results,
+    }
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
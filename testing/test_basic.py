@@ -1,5 +1,8 @@
+import json
+import pstats
 import sys
 import textwrap
+import time
 
 import pytest
 
@@ -282,6 +285,42 @@ def test_blockon_in_fixture(testdir, cmd_opts):
     assert_outcomes(rr, {"passed": 2, "failed": 1})
 
 
+def test_blockon_on_configure_time_reactor(testdir, cmd_opts, request):
+    # asyncio reactors share their event loop, which runs those calls
+    skip_if_reactor_not(request, "default")
+    test_file = """
+    from twisted.internet import reactor, defer
+    import pytest
+    import pytest_twisted
+
+    @pytest.fixture
+    def stale():
+        d = defer.Deferred()
+        reactor.callLater(0.01, d.callback, None)
+        return pytest_twisted.blockon(d)
+
+    def test_stale(stale):
+        pass
+
+    @pytest_twisted.inlineCallbacks
+    def test_stale_body():
+        d = defer.Deferred()
+        reactor.callLater(0.01, d.callback, None)
+        yield d
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-v",
+        "--twisted-reactor-scope=function",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"error": 1, "failed": 1})
+    rr.stdout.fnmatch_lines(["*RuntimeError: blockon would wait forever*"] * 2)
+
+
 @skip_if_no_async_await()
 def test_blockon_in_fixture_async(testdir, cmd_opts):
     test_file = """
@@ -532,3 +571,1656 @@ def test_twisted_for_marked_only_tests_with_cmdopt(testdir, cmd_opts_marked_only
     testdir.makepyfile(test_file)
     rr = testdir.run(sys.executable, "-m", "pytest", *cmd_opts_marked_only)
     assert_outcomes(rr, {"passed": 2})
+
+
+def test_reactor_scope_session(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import reactor, defer
+
+    def test_succeed():
+        d = defer.Deferred()
+        reactor.callLater(0.01, d.callback, 1)
+        return d
+
+    def test_same_reactor():
+        import twisted.internet
+        assert twisted.internet.reactor is reactor
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "--twisted-reactor-scope=session",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 2})
+
+
+def test_reactor_scope_marker(testdir, cmd_opts):
+    test_file = """
+    import pytest
+    import twisted.internet
+
+    pytestmark = pytest.mark.twisted_reactor_scope("module")
+
+    reactors = []
+
+    def test_first():
+        reactors.append(twisted.internet.reactor)
+
+    def test_second():
+        assert reactors == [twisted.internet.reactor]
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(sys.executable, "-m", "pytest", *cmd_opts)
+    assert_outcomes(rr, {"passed": 2})
+
+
+def test_reactor_scope_dirty_reactor_is_cleaned(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import defer, reactor
+    import twisted.internet
+
+    def test_leave_delayed_call():
+        reactor.callLater(100, lambda: None)
+
+    def test_same_reactor():
+        assert twisted.internet.reactor is reactor
+        assert reactor.getDelayedCalls() == []
+
+    def test_succeed():
+        d = defer.Deferred()
+        reactor.callLater(0.01, d.callback, 1)
+        return d
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "--twisted-reactor-scope=session",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 3})
+    rr.stdout.fnmatch_lines(
+        ["*DirtyReactorWarning: reactor left dirty by *test_leave_delayed*"]
+    )
+
+
+def test_reactor_pool(testdir, cmd_opts, request):
+    skip_if_reactor_not(request, "default")
+    test_file = """
+    from twisted.internet import defer
+    import twisted.internet
+
+    reactors = []
+
+    def test_first():
+        reactors.append(twisted.internet.reactor)
+
+    def test_second():
+        reactor = twisted.internet.reactor
+        assert reactor not in reactors
+        d = defer.Deferred()
+        reactor.callLater(0.01, d.callback, 1)
+        return d
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "--twisted-reactor-pool=2", *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 2})
+
+
+def test_reactor_pool_build_error(testdir, cmd_opts, request):
+    skip_if_reactor_not(request, "default")
+    testdir.makeconftest("""
+    import errno
+
+    import pytest_twisted
+
+    class UnbuildableReactor(object):
+        def __init__(self):
+            raise OSError(errno.EMFILE, "Too many open files")
+
+    def pytest_sessionstart(session):
+        pytest_twisted._instances.reactor_pool.drain()
+        pytest_twisted._instances.reactor_pool = pytest_twisted._ReactorPool(
+            UnbuildableReactor, depth=2
+        )
+    """)
+    testdir.makepyfile("""
+    def test_first():
+        pass
+
+    def test_second():
+        pass
+    """)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "--twisted-reactor-pool=2", *cmd_opts
+    )
+    assert_outcomes(rr, {"error": 2})
+    rr.stdout.fnmatch_lines(["*Too many open files*"])
+
+
+def test_reactor_pool_unsupported_reactor(testdir, request):
+    skip_if_reactor_not(request, "default")
+    testdir.makepyfile("""
+    def test_succeed():
+        pass
+    """)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "--reactor=asyncio",
+        "--twisted-reactor-pool=2",
+    )
+    assert "not supported with --reactor=asyncio" in rr.stderr.str()
+
+
+def test_twisted_durations(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import defer
+    import twisted.internet
+
+    def test_succeed_later():
+        d = defer.Deferred()
+        twisted.internet.reactor.callLater(0.01, d.callback, 1)
+        return d
+
+    def test_succeed():
+        pass
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "--twisted-durations=1",
+        "--twisted-durations-json=durations.json",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 2})
+    rr.stdout.fnmatch_lines(
+        [
+            "*slowest 1 twisted reactor overheads*",
+            "*s install=*s dispatch=*s resume=*s teardown=*s test_*",
+        ]
+    )
+
+    durations = json.loads(testdir.tmpdir.join("durations.json").read())
+    assert [entry["nodeid"] for entry in durations] == [
+        "test_twisted_durations.py::test_succeed_later",
+        "test_twisted_durations.py::test_succeed",
+    ]
+    assert all(entry["install"] > 0 for entry in durations)
+
+
+def test_stall_threshold(testdir, cmd_opts):
+    test_file = """
+    import time
+
+    from twisted.internet import defer
+    import twisted.internet
+
+    def block_reactor(d):
+        time.sleep(0.2)
+        d.callback(None)
+
+    def test_stall():
+        d = defer.Deferred()
+        twisted.internet.reactor.callLater(0.01, block_reactor, d)
+        return d
+
+    def test_no_stall():
+        d = defer.Deferred()
+        twisted.internet.reactor.callLater(0.01, d.callback, None)
+        return d
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-rP",
+        "--twisted-stall-threshold=50ms",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 2})
+    rr.stdout.fnmatch_lines(
+        [
+            "*twisted reactor stalls over 0.050s*",
+            "1 stall(s), longest 0.*s test_stall_threshold.py::test_stall",
+        ]
+    )
+    rr.stdout.fnmatch_lines(
+        [
+            "*Captured twisted stalls call*",
+            "reactor stalled for 0.*s (threshold 0.050s) in block_reactor *",
+        ]
+    )
+    assert "test_no_stall" not in rr.stdout.str().split("stalls over")[-1]
+
+
+def test_twisted_timeout(testdir, cmd_opts):
+    test_file = """
+    import pytest
+    import pytest_twisted
+    from twisted.internet import defer
+    import twisted.internet
+
+    cancelled = []
+
+    @pytest.mark.twisted_timeout(0.1)
+    @pytest_twisted.inlineCallbacks
+    def test_marker():
+        twisted.internet.reactor.callLater(100, lambda: None)
+        try:
+            yield defer.Deferred()
+        except defer.CancelledError:
+            cancelled.append(True)
+            raise
+
+    def test_ini():
+        return defer.Deferred()
+
+    def test_cancelled():
+        assert cancelled == [True]
+
+    def test_succeed():
+        d = defer.Deferred()
+        twisted.internet.reactor.callLater(0.01, d.callback, None)
+        return d
+    """
+    testdir.makepyfile(test_file)
+    testdir.makeini("""
+    [pytest]
+    twisted_timeout = 200ms
+    """)
+    rr = testdir.run(sys.executable, "-m", "pytest", *cmd_opts)
+    assert_outcomes(rr, {"passed": 2, "failed": 2})
+    rr.stdout.fnmatch_lines(
+        [
+            "*ReactorTimeoutError: timed out after 0.100s",
+            "*pending delayed calls:",
+            "*    <DelayedCall *<lambda>()>",
+            "*readers:",
+            "*    none",
+        ]
+    )
+    assert "timed out after 0.200s" in rr.stdout.str()
+
+
+def test_xdist_worker_timings(testdir, cmd_opts):
+    pytest.importorskip("xdist")
+    test_file = """
+    import pytest
+
+    @pytest.mark.parametrize("n", range(4))
+    def test_succeed(n):
+        pass
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-n",
+        "2",
+        "--twisted-durations=0",
+        "--twisted-durations-json=durations.json",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 4})
+    rr.stdout.fnmatch_lines(
+        [
+            "*twisted reactor overhead per worker*",
+            "gw?: * tests configure=*s install=*s *",
+            "gw?: * tests configure=*s install=*s *",
+            "*slowest twisted reactor overheads*",
+        ]
+    )
+
+    durations = json.loads(testdir.tmpdir.join("durations.json").read())
+    assert len(durations) == 4
+
+
+def test_xdist_worker_reuses_reactor(testdir, cmd_opts):
+    pytest.importorskip("xdist")
+    test_file = """
+    import pytest
+    import twisted.internet
+
+    reactors = set()
+
+    @pytest.mark.parametrize("n", range(4))
+    def test_same_reactor(n):
+        reactors.add(twisted.internet.reactor)
+        assert len(reactors) == 1
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(sys.executable, "-m", "pytest", "-n", "1", *cmd_opts)
+    assert_outcomes(rr, {"passed": 4})
+
+
+@pytest.mark.parametrize(
+    "mode, outcomes",
+    (
+        ("warn", {"passed": 3, "warnings": 2}),
+        ("error", {"passed": 3, "error": 2}),
+    ),
+)
+def test_dirty_reactor(testdir, cmd_opts, mode, outcomes):
+    test_file = """
+    from twisted.internet import defer
+    import twisted.internet
+
+    def test_delayed_call():
+        twisted.internet.reactor.callLater(100, lambda: None)
+
+    def test_unhandled_error():
+        defer.fail(ZeroDivisionError("boom"))
+
+    def test_clean():
+        d = defer.Deferred()
+        twisted.internet.reactor.callLater(0.01, d.callback, None)
+        return d
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "--twisted-dirty-reactor={}".format(mode),
+        *cmd_opts
+    )
+    assert_outcomes(rr, outcomes)
+    rr.stdout.fnmatch_lines(
+        [
+            "*twisted dirty reactors*",
+            "2 test(s) left 1 delayed call(s), 0 reader(s), 0 writer(s) "
+            "and 1 unhandled error(s) behind",
+        ]
+    )
+    assert "    boom" in rr.stdout.str()
+
+
+@pytest.mark.skipif(
+    not pytest_twisted._cleans_failures,
+    reason="twisted does not clean failures",
+)
+def test_failure_frames_result(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import defer
+
+    def failing():
+        d = defer.Deferred()
+        d.addCallback(lambda _: 1 / 0)
+        d.callback(None)
+        return d
+
+    handled = []
+
+    def test_handled():
+        d = failing()
+        assert d.result.tb is not None
+        d.addErrback(handled.append)
+
+    def test_handled_cleaned():
+        assert handled[0].tb is None
+
+    def test_result():
+        return failing()
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "--twisted-failure-frames=result",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 2, "failed": 1})
+    rr.stdout.fnmatch_lines(
+        [
+            "*1 / 0*",
+            "*twisted failure frames*",
+            "twisted *: cleaned 1 failure(s) once the test function "
+            "returned, releasing "
+            "* frame(s) with * bytes of locals",
+            "twisted *: cleaned 1 failure(s) after their test, releasing "
+            "* frame(s) with * bytes of locals",
+        ]
+    )
+
+
+@pytest.mark.skipif(
+    pytest_twisted._cleans_failures,
+    reason="twisted cleans failures",
+)
+def test_failure_frames_result_unsupported(testdir, cmd_opts):
+    testdir.makepyfile("""
+    def test_succeed():
+        pass
+    """)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "--twisted-failure-frames=result",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 1})
+    rr.stdout.fnmatch_lines(
+        [
+            "*twisted failure frames*",
+            "twisted * does not clean failures, --twisted-failure-frames "
+            "has no effect",
+        ]
+    )
+
+
+def test_failure_frames_restored(testdir, cmd_opts):
+    conftest_file = """
+    from twisted.python import failure
+
+    original = failure.Failure.cleanFailure
+
+    def pytest_unconfigure(config):
+        assert failure.Failure.cleanFailure == original
+    """
+    testdir.makeconftest(conftest_file)
+    testdir.makepyfile("""
+    def test_succeed():
+        pass
+    """)
+    rr = testdir.run(sys.executable, "-m", "pytest", *cmd_opts)
+    assert_outcomes(rr, {"passed": 1})
+    assert "AssertionError" not in rr.stderr.str()
+
+
+@skip_if_no_async_await()
+def test_async_asyncio_task(testdir, cmd_opts, request):
+    skip_if_reactor_not(request, "asyncio")
+    test_file = """
+    import asyncio
+
+    from twisted.internet import defer
+    import pytest
+    import pytest_twisted
+
+    async def test_undecorated():
+        d = defer.Deferred()
+        pytest_twisted._instances.reactor.callLater(0.01, d.callback, 1)
+        assert await d == 1
+        await asyncio.sleep(0.01)
+
+    @pytest_twisted.ensureDeferred
+    async def test_decorated():
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        loop.call_later(0.01, future.set_result, 2)
+        assert await future == 2
+        with pytest.raises(ZeroDivisionError):
+            await defer.fail(ZeroDivisionError())
+
+    async def test_fail():
+        d = defer.Deferred()
+        reactor = pytest_twisted._instances.reactor
+        reactor.callLater(0.01, d.errback, KeyError())
+        await d
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(sys.executable, "-m", "pytest", "-v", *cmd_opts)
+    assert_outcomes(rr, {"passed": 2, "failed": 1})
+    rr.stdout.fnmatch_lines(["*KeyError*"])
+
+
+@skip_if_no_async_await()
+def test_async_asyncio_task_timeout(testdir, cmd_opts, request):
+    skip_if_reactor_not(request, "asyncio")
+    test_file = """
+    import pytest
+    import pytest_twisted
+    from twisted.internet import defer, task
+
+    cancelled = []
+
+    @pytest.mark.twisted_timeout(0.1)
+    async def test_timeout():
+        reactor = pytest_twisted._instances.reactor
+        d = task.deferLater(reactor, 100, lambda: None)
+        d.addErrback(cancelled.append)
+        await d
+
+    def test_cancelled():
+        assert cancelled[0].check(defer.CancelledError)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "--twisted-dirty-reactor=error",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 1, "failed": 1})
+    rr.stdout.fnmatch_lines(["*ReactorTimeoutError: timed out after 0.100s"])
+    assert "DirtyReactorError" not in rr.stdout.str()
+
+
+@pytest.mark.parametrize(
+    "opts, outcomes",
+    [
+        ((), {"passed": 1, "failed": 3}),
+        (("--twisted-direct-call",), {"passed": 3, "failed": 1}),
+    ],
+)
+def test_sync_tests_skip_reactor(testdir, cmd_opts, opts, outcomes):
+    test_file = """
+    import greenlet
+    from twisted.internet import defer, task
+    import pytest_twisted
+
+    def outside_reactor():
+        gr_twisted = pytest_twisted._instances.gr_twisted
+        return greenlet.getcurrent() is not gr_twisted
+
+    def test_sync():
+        assert outside_reactor()
+
+    def test_fired():
+        assert outside_reactor()
+        return defer.succeed(None)
+
+    def test_fired_failure():
+        assert outside_reactor()
+        return defer.fail(KeyError())
+
+    @pytest_twisted.inlineCallbacks
+    def test_waits():
+        reactor = pytest_twisted._instances.reactor
+        yield task.deferLater(reactor, 0.01, lambda: None)
+        assert not outside_reactor()
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(sys.executable, "-m", "pytest", *(cmd_opts + opts))
+    assert_outcomes(rr, outcomes)
+
+
+def test_thread_driver(testdir, cmd_opts, request):
+    skip_if_reactor_not(request, "default")
+    test_file = """
+    import threading
+
+    import pytest
+    import pytest_twisted
+    from twisted.internet import defer, task
+
+    main_thread = threading.current_thread()
+
+    def reactor():
+        return pytest_twisted._instances.reactor
+
+    @pytest.fixture
+    def value():
+        assert threading.current_thread() is main_thread
+        return pytest_twisted.blockon(
+            task.deferLater(reactor(), 0.01, lambda: 42)
+        )
+
+    @pytest_twisted.inlineCallbacks
+    def test_waits(value):
+        assert threading.current_thread() is not main_thread
+        assert reactor().running
+        yield task.deferLater(reactor(), 0.01, lambda: None)
+        assert value == 42
+
+    def test_same_reactor():
+        assert reactor() is pytest_twisted._instances._reactor_original
+
+    def test_blockon_in_test():
+        pytest_twisted.blockon(defer.succeed(None))
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "--twisted-driver=thread",
+        "--twisted-durations=0",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 2, "failed": 1})
+    rr.stdout.fnmatch_lines(
+        [
+            "*blockon cannot be called from the reactor thread*",
+            "*twisted dispatch latency*",
+            "thread driver: * call(s), mean *s, longest *s",
+        ]
+    )
+
+
+@skip_if_no_async_await()
+def test_thread_driver_blockon_each(testdir, cmd_opts, request):
+    skip_if_reactor_not(request, "default")
+    test_file = """
+    import pytest_twisted
+    from twisted.internet import task
+
+    def reactor():
+        return pytest_twisted._instances.reactor
+
+    async def test_async_for():
+        deferreds = [
+            task.deferLater(reactor(), delay, lambda d=delay: d)
+            for delay in (0.02, 0.01)
+        ]
+        results = []
+        async for result in pytest_twisted.blockon_each(deferreds):
+            results.append(result)
+        assert results == [0.01, 0.02]
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "--twisted-driver=thread", *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 1})
+
+
+@skip_if_no_async_await()
+def test_thread_driver_async_fixture(testdir, cmd_opts, request):
+    skip_if_reactor_not(request, "default")
+    test_file = """
+    import threading
+    import time
+
+    import pytest
+    import pytest_twisted
+    from twisted.internet import defer, task
+
+    threads = []
+
+    def record_thread():
+        threads.append(threading.current_thread().name)
+
+    @pytest.fixture
+    async def resource():
+        record_thread()
+        yield
+        record_thread()
+
+    class WatchedDeferred(defer.Deferred):
+        watchers = set()
+
+        def addCallbacks(self, *args, **kwargs):
+            self.watchers.add(threading.current_thread().name)
+            return defer.Deferred.addCallbacks(self, *args, **kwargs)
+
+    @pytest.fixture
+    def watched():
+        d = WatchedDeferred()
+        d.callback(None)
+        pytest_twisted.blockon_all([d])
+
+    def test_fixture(resource, watched):
+        assert WatchedDeferred.watchers == {"pytest-twisted reactor"}
+
+    def test_threads():
+        assert threads == ["pytest-twisted reactor"] * 2
+
+    def sleep(delay):
+        reactor = pytest_twisted._instances.reactor
+        return task.deferLater(reactor, delay, lambda: None)
+
+    @pytest.fixture
+    def started():
+        return time.time()
+
+    @pytest.fixture
+    async def slow_a():
+        await sleep(0.3)
+
+    @pytest.fixture
+    async def slow_b():
+        await sleep(0.3)
+
+    def test_concurrent_setup(started, slow_a, slow_b):
+        assert time.time() - started < 0.5
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "--twisted-driver=thread", *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 3})
+
+
+def test_twisted_auto_mark(testdir, cmd_opts):
+    test_file = """
+    import pytest
+    import pytest_twisted
+    from twisted.internet import defer, task
+
+    def reactor():
+        return pytest_twisted._instances.reactor
+
+    @pytest.fixture
+    def waited():
+        return pytest_twisted.blockon(task.deferLater(reactor(), 0, int))
+
+    def test_plain():
+        assert reactor() is None
+
+    def test_plain_deferred():
+        assert reactor() is None
+        return defer.fail(ZeroDivisionError())
+
+    @pytest.mark.twisted_timeout(0.1)
+    def test_plain_deferred_never_fires():
+        assert reactor() is None
+        return defer.Deferred()
+
+    @pytest_twisted.inlineCallbacks
+    def test_decorated():
+        yield task.deferLater(reactor(), 0, int)
+
+    @pytest.mark.twisted
+    def test_marked():
+        return task.deferLater(reactor(), 0, int)
+
+    def test_blockon_fixture(waited, request):
+        assert waited == 0
+        assert request.node.get_closest_marker("twisted") is not None
+
+    @pytest.fixture
+    def waited_all():
+        return pytest_twisted.blockon_all([task.deferLater(reactor(), 0, int)])
+
+    def test_blockon_all_fixture(waited_all, request):
+        assert waited_all == [0]
+        assert request.node.get_closest_marker("twisted") is not None
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "-v", "--twisted-auto-mark", *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 5, "failed": 2})
+    rr.stdout.fnmatch_lines(
+        [
+            "*ZeroDivisionError",
+            "*ReactorTimeoutError: timed out after 0.100s",
+        ]
+    )
+
+
+def test_twisted_concurrency(testdir, cmd_opts):
+    test_file = """
+    import time
+
+    import pytest
+    import pytest_twisted
+    from twisted.internet import task
+
+    @pytest.fixture(scope="module")
+    def started():
+        return time.time()
+
+    @pytest.mark.parametrize("i", range(6))
+    def test_wait(i, started):
+        reactor = pytest_twisted._instances.reactor
+        return task.deferLater(reactor, 0.2, lambda: 1 / (i - 3))
+
+    def test_elapsed(started, tmpdir):
+        # the function scoped tmpdir is not set up ahead of time
+        assert time.time() - started < 1.0
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "-v", "-s", "-p", "no:logging",
+        "--twisted-concurrency=3", *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 6, "failed": 1})
+    rr.stdout.fnmatch_lines(["*test_wait?3? FAILED*"])
+
+
+@pytest.mark.parametrize(
+    "opts, overlap",
+    [
+        (("-s", "-p", "no:logging"), True),
+        (("-s", "-p", "no:logging", "--twisted-io-stats=1"), False),
+        (("-s",), False),
+        (("-p", "no:logging"), False),
+    ],
+)
+def test_twisted_concurrency_records_per_test(
+    testdir, cmd_opts, opts, overlap
+):
+    test_file = """
+    import pytest
+    import pytest_twisted
+    from twisted.internet import task
+
+    events = []
+
+    @pytest.mark.parametrize("i", range(2))
+    def test_wait(i):
+        events.append(("start", i))
+        reactor = pytest_twisted._instances.reactor
+        return task.deferLater(reactor, 0.05, events.append, ("end", i))
+
+    @pytest.mark.twisted_concurrent(1)
+    def test_overlap():
+        overlap = events.index(("start", 1)) < events.index(("end", 0))
+        assert overlap is OVERLAP
+    """.replace("OVERLAP", str(overlap))
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "--twisted-concurrency=3",
+        *(cmd_opts + opts)
+    )
+    assert_outcomes(rr, {"passed": 3})
+
+
+def test_clock_reactor(testdir):
+    test_file = """
+    import time
+
+    import pytest
+    import pytest_twisted
+    from twisted.internet import defer, task
+
+    def reactor():
+        return pytest_twisted._instances.reactor
+
+    @pytest.fixture
+    def slow():
+        d = defer.Deferred()
+        reactor().callLater(30, d.callback, 30)
+        return pytest_twisted.blockon(d)
+
+    def test_blockon(slow):
+        assert slow == 30
+
+    @pytest_twisted.inlineCallbacks
+    def test_order():
+        calls = []
+        start = reactor().seconds()
+        for delay in (20, 5, 10):
+            reactor().callLater(delay, calls.append, delay)
+        yield task.deferLater(reactor(), 60, lambda: None)
+        assert calls == [5, 10, 20]
+        assert reactor().seconds() - start >= 60
+
+    def test_thread():
+        from twisted.internet import threads
+        return threads.deferToThread(time.sleep, 0.1)
+    """
+    testdir.makepyfile(test_file)
+    start = time.time()
+    rr = testdir.run(sys.executable, "-m", "pytest", "-v", "--reactor=clock")
+    assert_outcomes(rr, {"passed": 3})
+    assert time.time() - start < 20
+
+
+def test_clock_reactor_timeout(testdir):
+    testdir.makeini("""
+    [pytest]
+    twisted_timeout = 30s
+    """)
+    test_file = """
+    import pytest
+    import pytest_twisted
+    from twisted.internet import defer, task
+
+    def test_virtual_wait():
+        reactor = pytest_twisted._instances.reactor
+        return task.deferLater(reactor, 60, lambda: None)
+
+    @pytest.mark.twisted_timeout(0.2)
+    def test_hangs():
+        return defer.Deferred()
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(sys.executable, "-m", "pytest", "-v", "--reactor=clock")
+    assert_outcomes(rr, {"passed": 1, "failed": 1})
+    rr.stdout.fnmatch_lines(["*ReactorTimeoutError: timed out after 0.200s"])
+
+
+def test_reactor_auto(testdir):
+    test_file = """
+    import pytest_twisted
+    from twisted.internet import defer
+
+    def test_reactor():
+        assert pytest_twisted._config.reactor_name in (
+            name for name, _ in pytest_twisted.auto_reactors
+        )
+        return defer.succeed(None)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(sys.executable, "-m", "pytest", "--reactor=auto")
+    assert_outcomes(rr, {"passed": 1})
+
+
+def test_reactor_entry_point(testdir):
+    # an installed distribution providing a reactor through an entry point
+    testdir.makepyfile(
+        myreactor="""
+        import pytest_twisted
+
+        def install():
+            pytest_twisted.init_select_reactor()
+
+        install.reinstallable = False
+        """,
+        # only loaded when selected
+        brokenreactor="""
+        raise ImportError("not available")
+        """,
+    )
+    dist_info = testdir.mkdir("myreactor-1.0.dist-info")
+    dist_info.join("METADATA").write(
+        "Metadata-Version: 2.1\nName: myreactor\nVersion: 1.0\n"
+    )
+    dist_info.join("entry_points.txt").write(
+        "[pytest_twisted.reactors]\nmine = myreactor:install\n"
+        "broken = brokenreactor:install\n"
+    )
+    test_file = """
+    import pytest_twisted
+    from twisted.internet.selectreactor import SelectReactor
+
+    def test_first():
+        assert isinstance(pytest_twisted._instances.reactor, SelectReactor)
+        pytest_twisted._instances.reactor.first = True
+
+    def test_second():
+        # not reinstallable, so the reactor is kept for the session
+        assert pytest_twisted._instances.reactor.first
+    """
+    testdir.makepyfile(test_file)
+    # the test directory is on the PYTHONPATH of the pytest subprocess
+    rr = testdir.run(sys.executable, "-m", "pytest", "--reactor=mine")
+    assert_outcomes(rr, {"passed": 2})
+
+
+def test_asyncio_uvloop_reactor(testdir):
+    pytest.importorskip("uvloop")
+    test_file = """
+    import asyncio
+
+    import uvloop
+    import pytest_twisted
+    from twisted.internet import task
+
+    loops = []
+
+    def test_uvloop():
+        reactor = pytest_twisted._instances.reactor
+        assert isinstance(reactor._asyncioEventloop, uvloop.Loop)
+        loops.append(reactor._asyncioEventloop)
+        return task.deferLater(reactor, 0.01, lambda: None)
+
+    def test_reinstalled():
+        reactor = pytest_twisted._instances.reactor
+        assert reactor._asyncioEventloop is loops[0]
+        assert asyncio.get_event_loop() is loops[0]
+        return task.deferLater(reactor, 0.01, lambda: None)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "--reactor=asyncio-uvloop"
+    )
+    assert_outcomes(rr, {"passed": 2})
+
+
+def test_asyncio_uvloop_reactor_missing(testdir):
+    # shadows an installed uvloop, the test directory comes first on the path
+    testdir.makepyfile(uvloop="raise ImportError('no uvloop')")
+    testdir.makepyfile("""
+    def test_nothing():
+        pass
+    """)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "--reactor=asyncio-uvloop"
+    )
+    assert "requires uvloop to be installed" in rr.stderr.str()
+    assert rr.ret != 0
+
+
+def test_reactor_unavailable(testdir):
+    # shadows an installed PyGObject like test_asyncio_uvloop_reactor_missing
+    testdir.makepyfile(gi="raise ImportError('no gi')")
+    testdir.makepyfile("""
+    def test_nothing():
+        pass
+    """)
+    rr = testdir.run(sys.executable, "-m", "pytest", "--reactor=gi")
+    assert "--reactor=gi is not available: no gi" in rr.stderr.str()
+    assert "INTERNALERROR" not in rr.stdout.str() + rr.stderr.str()
+    assert rr.ret != 0
+
+
+def test_blockon_all(testdir, cmd_opts):
+    test_file = """
+    import gc
+
+    import pytest
+    import pytest_twisted
+    from twisted.internet import defer
+    from twisted.python import log
+
+    def later(delay, value):
+        d = defer.Deferred()
+        reactor = pytest_twisted._instances.reactor
+        if isinstance(value, Exception):
+            reactor.callLater(delay, d.errback, value)
+        else:
+            reactor.callLater(delay, d.callback, value)
+        return d
+
+    @pytest.fixture
+    def values():
+        return pytest_twisted.blockon_all(
+            [later(0.03, 1), later(0.01, 2), defer.succeed(3)]
+        )
+
+    def test_all(values):
+        assert values == [1, 2, 3]
+
+    @pytest.fixture
+    def all_failures():
+        with pytest.raises(pytest_twisted.BlockonFailuresError) as e:
+            pytest_twisted.blockon_all(
+                [
+                    later(0.01, KeyError("a")),
+                    later(0, 1),
+                    later(0, ValueError()),
+                ],
+                consume_errors=True,
+            )
+        return e.value
+
+    def test_all_failures(all_failures):
+        assert [index for index, _ in all_failures.failures] == [0, 2]
+        assert "[0] KeyError" in str(all_failures)
+
+    @pytest.fixture
+    def each():
+        deferreds = [later(0.03, 1), later(0.01, 2), later(0.02, 3)]
+        return list(pytest_twisted.blockon_each(deferreds))
+
+    def test_each(each):
+        assert each == [2, 3, 1]
+
+    @pytest.fixture
+    def each_failures():
+        results = []
+        with pytest.raises(pytest_twisted.BlockonFailuresError):
+            for result in pytest_twisted.blockon_each(
+                [later(0.01, 1), later(0, KeyError()), later(0.02, 2)],
+                consume_errors=True,
+            ):
+                results.append(result)
+        return results
+
+    def test_each_failures(each_failures):
+        assert each_failures == [1, 2]
+
+    @pytest.fixture
+    def unhandled():
+        events = []
+        log.addObserver(events.append)
+        with pytest.raises(pytest_twisted.BlockonFailuresError):
+            pytest_twisted.blockon_all([later(0, KeyError())])
+        with pytest.raises(pytest_twisted.BlockonFailuresError):
+            list(pytest_twisted.blockon_each([later(0, ValueError())]))
+        gc.collect()
+        log.removeObserver(events.append)
+        return [event for event in events if event.get("isError")]
+
+    def test_raised_failures_consumed(unhandled):
+        assert unhandled == []
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(sys.executable, "-m", "pytest", "-v", *cmd_opts)
+    assert_outcomes(rr, {"passed": 5})
+
+
+@skip_if_no_async_await()
+def test_blockon_each_async_for(testdir, cmd_opts):
+    test_file = """
+    import pytest_twisted
+    from twisted.internet import task
+
+    @pytest_twisted.ensureDeferred
+    async def test_each():
+        reactor = pytest_twisted._instances.reactor
+        deferreds = [
+            task.deferLater(reactor, delay, lambda delay=delay: delay)
+            for delay in (0.02, 0.01, 0.03)
+        ]
+        results = []
+        async for result in pytest_twisted.blockon_each(deferreds):
+            results.append(result)
+        assert results == [0.01, 0.02, 0.03]
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(sys.executable, "-m", "pytest", "-v", *cmd_opts)
+    assert_outcomes(rr, {"passed": 1})
+
+
+@skip_if_no_async_await()
+def test_async_fixture(testdir, cmd_opts):
+    test_file = """
+    import time
+
+    import pytest
+    import pytest_twisted
+    from twisted.internet import defer, task
+
+    def sleep(delay, value=None):
+        reactor = pytest_twisted._instances.reactor
+        return task.deferLater(reactor, delay, lambda: value)
+
+    events = []
+
+    @pytest.fixture
+    async def first():
+        return await sleep(0.2, 1)
+
+    @pytest.fixture
+    async def second():
+        events.append("second set up")
+        yield await sleep(0.2, 2)
+        await sleep(0.01)
+        events.append("second torn down")
+
+    @pytest.fixture
+    @pytest_twisted.inlineCallbacks
+    def third(first):
+        value = yield sleep(0.01, first + 2)
+        defer.returnValue(value)
+
+    def test_values(first, second, third):
+        assert (first, second, third) == (1, 2, 3)
+
+    def test_teardown():
+        assert events == ["second set up", "second torn down"]
+
+    @pytest.fixture
+    def started():
+        return time.time()
+
+    @pytest.fixture
+    async def slow_a():
+        await sleep(0.3)
+
+    @pytest.fixture
+    async def slow_b():
+        await sleep(0.3)
+
+    def test_concurrent_setup(started, slow_a, slow_b):
+        assert time.time() - started < 0.5
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(sys.executable, "-m", "pytest", "-v", *cmd_opts)
+    assert_outcomes(rr, {"passed": 3})
+
+
+@skip_if_no_async_await()
+def test_async_fixture_started_but_not_set_up(testdir, cmd_opts):
+    test_file = """
+    import pytest
+
+    events = []
+
+    @pytest.fixture
+    async def broken():
+        raise RuntimeError("broken")
+
+    @pytest.fixture
+    async def resource():
+        events.append("set up")
+        yield
+        events.append("torn down")
+
+    def test_broken(broken, resource):
+        pass
+
+    def test_torn_down():
+        assert events == ["set up", "torn down"]
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(sys.executable, "-m", "pytest", "-v", *cmd_opts)
+    assert_outcomes(rr, {"passed": 1, "error": 1})
+
+
+@skip_if_no_async_await()
+def test_async_fixture_setup_order(testdir, cmd_opts):
+    test_file = """
+    import pytest
+
+    events = []
+
+    @pytest.fixture
+    def prepared():
+        events.append("prepared")
+
+    @pytest.fixture
+    async def first():
+        events.append("first")
+
+    @pytest.fixture
+    async def second():
+        events.append("second")
+
+    def test_order(prepared, first, second):
+        assert events == ["prepared", "first", "second"]
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(sys.executable, "-m", "pytest", "-v", *cmd_opts)
+    assert_outcomes(rr, {"passed": 1})
+
+
+def test_threadpool_queueing(testdir, cmd_opts):
+    testdir.makeini("""
+    [pytest]
+    twisted_threadpool_maxthreads = 1
+    twisted_threadpool_shared = true
+    """)
+    test_file = """
+    import time
+
+    import pytest_twisted
+    from twisted.internet import defer, threads
+
+    pools = []
+
+    def test_queued():
+        reactor = pytest_twisted._instances.reactor
+        pools.append(reactor.getThreadPool())
+        assert reactor.getThreadPool().max == 1
+        return defer.gatherResults(
+            [threads.deferToThread(time.sleep, 0.05) for _ in range(3)]
+        )
+
+    def test_shared():
+        reactor = pytest_twisted._instances.reactor
+        assert reactor.getThreadPool() is pools[0]
+        return threads.deferToThread(time.sleep, 0)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "--twisted-threadpool-stats", *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 2})
+    rr.stdout.fnmatch_lines(
+        [
+            "*twisted thread pool queueing*",
+            "3 call(s), max queue depth ?, waited *test_queued",
+        ]
+    )
+    assert "test_shared" not in rr.stdout.str()
+
+    rr = testdir.run(sys.executable, "-m", "pytest", *cmd_opts)
+    assert_outcomes(rr, {"passed": 2})
+    assert "twisted thread pool queueing" not in rr.stdout.str()
+
+
+def test_twisted_profile(testdir, cmd_opts):
+    test_file = """
+    import pytest_twisted
+    from twisted.internet import defer
+
+    def reactor_callback(d):
+        d.callback(sum(range(1000)))
+
+    def test_profiled():
+        d = defer.Deferred()
+        pytest_twisted._instances.reactor.callLater(0.01, reactor_callback, d)
+        return d
+
+    def test_other():
+        pass
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "--twisted-profile=prof", *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 2})
+    profiles = testdir.tmpdir.join("prof")
+    assert sorted(p.basename for p in profiles.listdir("*.pstats")) == [
+        "session.pstats",
+        "test_twisted_profile.py_test_other.pstats",
+        "test_twisted_profile.py_test_profiled.pstats",
+    ]
+
+    stats = pstats.Stats(
+        str(profiles.join("test_twisted_profile.py_test_profiled.pstats"))
+    )
+    assert "reactor_callback" in [name for _, _, name in stats.stats]
+
+
+def test_twisted_trace_callbacks(testdir, cmd_opts):
+    test_file = """
+    import time
+
+    import pytest_twisted
+    from twisted.internet import defer
+
+    properties = []
+
+    def slow(result):
+        time.sleep(0.05)
+        return result
+
+    def nested(result, depth):
+        if depth:
+            return defer.succeed(result).addCallback(nested, depth - 1)
+        return result
+
+    @pytest_twisted.inlineCallbacks
+    def test_traced(record_property):
+        d = defer.Deferred()
+        d.addCallback(slow)
+        for _ in range(10):
+            d.addCallback(lambda result: result)
+        pytest_twisted._instances.reactor.callLater(0.01, d.callback, None)
+        yield d
+        yield nested(None, 3)
+        f = defer.fail(ZeroDivisionError())
+        f.addErrback(handled)
+        f.addBoth(both)
+
+    def handled(failure):
+        pass
+
+    def both(result):
+        pass
+
+    def test_untraced():
+        pass
+    """
+    testdir.makeconftest("""
+    def pytest_runtest_logreport(report):
+        if report.when == "teardown":
+            props = dict(report.user_properties)
+            if "twisted_callbacks" in props:
+                traced = props["twisted_callbacks"]
+                print("hottest", traced["hottest"][0]["callback"])
+                print("chain", traced["longest_chains"][0]["callbacks"])
+                print("depth", max(s["depth"] for s in traced["hottest"]))
+    """)
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-s",
+        "--twisted-trace-callbacks=0",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 2})
+    rr.stdout.fnmatch_lines(
+        [
+            "*hottest slow (*test_twisted_trace_callbacks.py:*)",
+            "chain 11",
+            "depth 2",
+            "*slowest twisted callback traces*",
+            "*s in * callback(s) test_twisted_trace_callbacks.py::test_traced",
+            "  hottest callbacks:",
+            "    *s 1 call(s), longest *s, depth 0: slow (*",
+            "*resuming test_traced from *test_twisted_trace_callbacks.py:*",
+            "  longest chains:",
+            "    11 callback(s) *",
+        ]
+    )
+    traces = rr.stdout.str().split("callback traces")[1]
+    assert "test_untraced" not in traces
+    assert "depth 0: handled (" in traces
+    assert "depth 0: both (" in traces
+
+
+def test_twisted_io_stats(testdir, cmd_opts):
+    test_file = """
+    import pytest_twisted
+    from twisted.internet import defer, endpoints, protocol
+    from twisted.protocols import wire
+
+    class Client(protocol.Protocol):
+        def __init__(self, chunks):
+            self.chunks = chunks
+            self.received = 0
+            self.done = defer.Deferred()
+
+        def connectionMade(self):
+            for chunk in self.chunks:
+                self.transport.write(chunk)
+
+        def dataReceived(self, data):
+            self.received += len(data)
+            if self.received == sum(len(chunk) for chunk in self.chunks):
+                self.transport.loseConnection()
+                self.done.callback(None)
+
+    @defer.inlineCallbacks
+    def echo(chunks):
+        reactor = pytest_twisted._instances.reactor
+        port = reactor.listenTCP(
+            0, protocol.Factory.forProtocol(wire.Echo), interface="127.0.0.1"
+        )
+        endpoint = endpoints.TCP4ClientEndpoint(
+            reactor, "127.0.0.1", port.getHost().port
+        )
+        client = yield endpoints.connectProtocol(endpoint, Client(chunks))
+        yield client.done
+        yield port.stopListening()
+
+    @pytest_twisted.inlineCallbacks
+    def test_tiny_writes():
+        yield echo([b"x"] * 100)
+
+    @pytest_twisted.inlineCallbacks
+    def test_buffered_write():
+        yield echo([b"x" * 100])
+
+    def test_no_io():
+        pass
+    """
+    testdir.makeconftest("""
+    def pytest_runtest_logreport(report):
+        if report.when == "teardown":
+            io = dict(report.user_properties).get("twisted_io")
+            if io is not None:
+                print(
+                    "{} read {bytes_read} written {bytes_written} "
+                    "connections {connections} writes {write_calls}".format(
+                        report.nodeid.split("::")[-1], **io
+                    )
+                )
+    """)
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable, "-m", "pytest", "-s", "--twisted-io-stats=1",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 3})
+    rr.stdout.fnmatch_lines(
+        [
+            "*test_tiny_writes read 200 written 200 connections 2 writes 101",
+            "*test_buffered_write read 200 written 200 connections 2 writes 2",
+            "*most twisted I/O of 1 tests*",
+            "2 connection(s), 200 byte(s) read in * doRead(s), 200 byte(s) "
+            "written in * doWrite(s) for 101 write(s), * iteration(s) "
+            "test_twisted_io_stats.py::test_tiny_writes",
+        ]
+    )
+    assert "test_no_io read" not in rr.stdout.str()
+
+
+def test_twisted_loopback(testdir, cmd_opts):
+    test_file = """
+    import pytest
+    import pytest_twisted
+    from twisted.internet import defer, endpoints, error, protocol
+    from twisted.protocols import wire
+
+    class Client(protocol.Protocol):
+        def __init__(self):
+            self.received = b""
+            self.lost = defer.Deferred()
+
+        def connectionMade(self):
+            self.transport.write(b"ping")
+            self.transport.loseConnection()
+
+        def dataReceived(self, data):
+            self.received += data
+
+        def connectionLost(self, reason):
+            self.lost.callback(self.received)
+
+    @defer.inlineCallbacks
+    def echo(reactor):
+        port = reactor.listenTCP(
+            0, protocol.Factory.forProtocol(wire.Echo), interface="127.0.0.1"
+        )
+        endpoint = endpoints.TCP4ClientEndpoint(
+            reactor, "127.0.0.1", port.getHost().port
+        )
+        client = yield endpoints.connectProtocol(endpoint, Client())
+        assert client.transport.getPeer().port == port.getHost().port
+        received = yield client.lost
+        yield port.stopListening()
+        defer.returnValue((client.transport, received))
+
+    @pytest.mark.twisted_loopback
+    @pytest_twisted.inlineCallbacks
+    def test_marked():
+        reactor = pytest_twisted._instances.reactor
+        transport, received = yield echo(reactor)
+        assert type(transport).__module__ == "twisted.test.iosim"
+
+    @pytest_twisted.inlineCallbacks
+    def test_fixture(twisted_loopback):
+        reactor = pytest_twisted._instances.reactor
+        transport, received = yield echo(reactor)
+        assert type(transport).__module__ == "twisted.test.iosim"
+
+        endpoint = endpoints.TCP4ClientEndpoint(reactor, "127.0.0.1", 1)
+        factory = protocol.Factory.forProtocol(protocol.Protocol)
+        with pytest.raises(error.ConnectError):
+            yield endpoint.connect(factory)
+        assert twisted_loopback.fallbacks == [
+            "connectTCP(127.0.0.1:1): no loopback server listening"
+        ]
+
+    @pytest_twisted.inlineCallbacks
+    def test_sockets():
+        reactor = pytest_twisted._instances.reactor
+        transport, received = yield echo(reactor)
+        assert type(transport).__module__ != "twisted.test.iosim"
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(sys.executable, "-m", "pytest", *cmd_opts)
+    assert_outcomes(rr, {"passed": 3})
+    rr.stdout.fnmatch_lines(
+        [
+            "*twisted loopback fallbacks*",
+            "test_twisted_loopback.py::test_fixture",
+            "    connectTCP(127.0.0.1:1): no loopback server listening",
+        ]
+    )
+
+
+def test_reactor_per_test(testdir, cmd_opts, request):
+    skip_if_reactor_not(request, "default")
+    test_file = """
+    import pytest
+    import pytest_twisted
+    from twisted.internet import task
+
+    reactors = []
+
+    def record(name):
+        from twisted.internet import reactor
+        reactors.append((name, type(reactor).__name__))
+        return task.deferLater(reactor, 0, lambda: None)
+
+    def test_default():
+        return record("default")
+
+    @pytest.mark.twisted(reactor="asyncio")
+    def test_asyncio():
+        return record("asyncio")
+
+    @pytest.mark.twisted(reactor="clock")
+    class TestClock:
+        def test_clock(self):
+            return record("clock")
+
+    @pytest.mark.twisted(reactor="asyncio")
+    def test_asyncio_again():
+        return record("asyncio again")
+
+    def test_default_again():
+        return record("default again")
+
+    def test_reactors():
+        assert [name for name, _ in reactors] == [
+            "default",
+            "default again",
+        ]
+
+    def teardown_module():
+        assert [name for name, _ in reactors] == [
+            "default",
+            "default again",
+            "asyncio",
+            "asyncio again",
+            "clock",
+        ]
+        types = dict(reactors)
+        assert types["default"] == types["default again"]
+        assert types["asyncio"] == types["asyncio again"]
+        assert types["asyncio"] == "AsyncioSelectorReactor"
+        assert types["clock"] == "VirtualTime" + types["default"]
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        sys.executable,
+        "-m",
+        "pytest",
+        "-v",
+        "--twisted-reactor-scope=module",
+        *cmd_opts
+    )
+    assert_outcomes(rr, {"passed": 6})
+    rr.stdout.fnmatch_lines(
+        [
+            "*::test_default PASSED*",
+            "*::test_default_again PASSED*",
+            "*::test_reactors PASSED*",
+            "*::test_asyncio PASSED*",
+            "*::test_asyncio_again PASSED*",
+            "*::TestClock::test_clock PASSED*",
+        ]
+    )
+
+
+def test_reactor_per_test_unknown(testdir, cmd_opts):
+    test_file = """
+    import pytest
+
+    @pytest.mark.twisted(reactor="no-such-reactor")
+    def test_unknown():
+        pass
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(sys.executable, "-m", "pytest", *cmd_opts)
+    rr.stderr.fnmatch_lines(
+        ["*test_unknown selects unknown reactor 'no-such-reactor'*"]
+    )